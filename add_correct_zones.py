@@ -1,10 +1,13 @@
+import os
+import hashlib
 import numpy as np
 import pandas as pd
-import geopandas as gpd
-from shapely.geometry import Point
-from geopandas import GeoDataFrame
 import matplotlib.pyplot as plt
 from data_storage import zip_to_neighborhood, legal_code_to_offense
+from offense_codes import get_offenses
+from arrest_store import stored_years, read_arrests, write_year, append_years, close_years, read_manifest, write_manifest
+from boundary_cache import load_bounds, update_cache
+from zone_assignment import zone_overrides, build_zone_layers, attach_zone_grid, assign_zones_cached, load_zone_cache, save_zone_cache, zone_cache_size
 
 """
 Processes new dataset for year and adds to existing data file
@@ -14,137 +17,224 @@ Processes new dataset for year and adds to existing data file
 current_year = 2023
 new_data_file = "NYPD_Arrest_Data__Year_to_Date_.csv"
 current_data_file = "arrest_data.csv"
+bounds_file = "shapefiles/all_bounds.geojson"
+zone_cache_file = "zone_cache.pkl"
+processes = 1 # Number of processes used to find zones; set above 1 to split the work across cores (needs the fork start method, so Linux only)
+simplify_tolerance = 0.0001 # Tolerance (in degrees, about 10m) of the simplified zone shapes used to test most points quickly; None to test every point against the full shapes
+use_zone_grid = False # Look up most points in a precomputed grid of zones instead of testing them against each polygon
+zone_grid_file = "zone_grid.npy"
+use_delta = True # Only process records that are new or changed since the last run; unchanged records keep their stored zones
+memory_limit = None # Memory (in MB) to stay within; set to stream the new data file in chunks rather than loading it all at once
 
 
-# Find the zone for the given object
-def get_zone(shapes_df, mode, row):
-    if row["geometry"].x == 0:
-        return None
-    elif mode == "zipcode" and row["geometry"].y == 40.706283 and row["geometry"].x == -73.950348:
-        # Hard code answer to common error
-        return "11211"
-    else:
-        # Find possible zones
-        poss_zones = shapes_df[shapes_df["geometry"].contains(row["geometry"])]
-
-        if len(poss_zones.index) == 1:
-            return poss_zones.iloc[0]["nameCol"]
-        
-        # If the point is not in any zone, find the zone it is nearest to
-        elif len(poss_zones.index) == 0:
-            min_dist = 1000
-            z = None
-
-            for i, r in shapes_df.iterrows():
-                if row["geometry"].distance(r["geometry"]) < min_dist:
-                    min_dist = row["geometry"].distance(r["geometry"])
-                    z = r["nameCol"]
-
-            return z
-
-        # If the point is in multiple zones, choose the zone it is farthest in to
-        else:
-            max_dist = 0
-            z = None
-
-            for i, r in poss_zones.iterrows():
-                if r["geometry"].exterior.distance(row["geometry"]) > max_dist:
-                    max_dist = r["geometry"].exterior.distance(row["geometry"])
-                    z = r["nameCol"]
-            
-            return z
-
 # Find corresponding neighborhoods (from zipcode) for each entry in the dataset
+    # Looks up every zipcode at once in a table indexed by zipcode, giving a categorical column of neighborhoods
 def get_neighborhoods(data):
-    neighs = []
-
-    for index, row in data.iterrows():
-        if not pd.isna(row['Zipcode']):
-            neighs.append(zip_to_neighborhood[int(row['Zipcode'])])
-        else:
-            neighs.append(np.nan)
-    
-    return neighs
-
-
-# Get the offense descriptions (from law code) for each entry in the dataset
-def get_offenses(data):
-    offenses = []
-
-    for index, row in data.iterrows():
-        if pd.isnull(row["LAW_CODE"]):
-            off = "Other"
-        else:
-            for lc in legal_code_to_offense:
-                if lc in row["LAW_CODE"]:
-                    off = legal_code_to_offense[lc]
-            if not off:
-                off = "Other"
-        offenses.append(off)
-    
-    return offenses
-
-
-# Get the zones (specified by mode) for each entry in the dataset
-def get_zones(gdf, shapes_df, mode):
-    actual_zone_values = []
-    for index, row in gdf.iterrows():
-        actual_zone_values.append(get_zone(shapes_df, mode, row))
-    
-    return actual_zone_values
-
-# Load new dataset
-data = pd.read_csv('arrest_data/' + new_data_file)
-
-# Fill any missing latitude and longitude values
-data["Latitude"] = data["Latitude"].fillna(0)
-data["Longitude"] = data["Longitude"].fillna(0)
-
-# Create geometric shapes for locating points geographically
-geometry = [Point(xy) for xy in zip(data['Longitude'], data['Latitude'])]
-gdf = GeoDataFrame(data, geometry=geometry)
+    neighborhoods = sorted(set(zip_to_neighborhood.values()))
+    zip_table = np.full(max(zip_to_neighborhood) + 1, -1, dtype=np.int16)
+    for zip, n in zip_to_neighborhood.items():
+        zip_table[zip] = neighborhoods.index(n)
 
-# Load in geographic shapes for zones
-# Source: https://github.com/BetaNYC/nyc-boundaries.git
-df = gpd.read_file("shapefiles/all_bounds.geojson")
+    zips = pd.to_numeric(data["Zipcode"]).to_numpy()
+    found = ~np.isnan(zips)
+    zip_ints = zips[found].astype(np.int64)
 
-# Define zones to add to dataset
-zones = {"Community District": "cd", "Police Precinct": "pp", "City Council District": "cc", "Congressional District": "nycongress", "Zipcode": "zipcode", "State Assembly District": "sa", "State Senate District": "ss"}
-display = False
+    # Every zipcode must have a neighborhood
+    unknown = (zip_ints < 0) | (zip_ints >= len(zip_table))
+    unknown[~unknown] = zip_table[zip_ints[~unknown]] == -1
+    if unknown.any():
+        raise KeyError("No neighborhood for zipcodes: " + ", ".join(str(z) for z in np.unique(zip_ints[unknown])))
 
-# Loop through data and add label for each new zone
-for z in zones:
-    print("Loading " + z + "...")
-    shapes_df = df[df["id"] == zones[z]]
+    codes = np.full(len(zips), -1, dtype=np.int16)
+    codes[found] = zip_table[zip_ints]
+
+    return pd.Categorical.from_codes(codes, categories=neighborhoods)
+
+
+# Hash the lookup tables used to add neighborhoods, offenses and hard coded zones, so stored records are processed again when any of them change
+def lookup_hash():
+    return hashlib.sha256(repr((zip_to_neighborhood, legal_code_to_offense, zone_overrides)).encode()).hexdigest()
+
+
+# Add specific time variables (year, quarter, month, and day of week) from the arrest date
+    # Each distinct date is parsed once, then mapped back on to every entry; quarters are numbered 0-3
+def add_time_columns(data):
+    codes, dates = pd.factorize(data["ARREST_DATE"])
+    dates = pd.DatetimeIndex(pd.to_datetime(dates, format="%m/%d/%Y"))
+
+    return data.assign(ARREST_QUARTER=((dates.month - 1) // 3).to_numpy(dtype=np.int8)[codes],
+                       ARREST_YEAR=dates.year.to_numpy(dtype=np.int16)[codes],
+                       ARREST_MONTH=dates.month.to_numpy(dtype=np.int8)[codes],
+                       ARREST_DAY_OF_WEEK=dates.dayofweek.to_numpy(dtype=np.int8)[codes])
+
+
+# Find the year of each arrest from its arrest date, parsing each distinct date once
+def arrest_years(data):
+    codes, dates = pd.factorize(data["ARREST_DATE"])
+
+    return pd.DatetimeIndex(pd.to_datetime(dates, format="%m/%d/%Y")).year.to_numpy()[codes]
+
+
+# Estimate the size (in bytes) of each row of a data file once loaded, from a sample of its first rows
+def row_size(path):
+    sample = pd.read_csv(path, nrows=10000, dtype=column_types)
+
+    return sample.memory_usage(deep=True).sum() / max(len(sample.index), 1)
 
-    if display:
-        shapes_df.plot()
-        plt.show()
-    
-    actual_zone_values = get_zones(gdf, shapes_df, zones[z])
 
-    data[z.replace(" ", "_")] = actual_zone_values
+# Estimate how many rows can be processed at once within the memory limit (in MB), given the size of each row
+    # Processing holds several copies of each chunk (raw rows, points, zone columns), so each row is allowed chunk_overhead times its raw size
+    # The zone cache is held in memory throughout and grows as new locations are found, so its current size is taken out of the limit
+def rows_per_chunk(row_bytes, memory_limit):
+    available = memory_limit * 1024 * 1024 - zone_cache_size(zone_cache)
 
-# Get neighborhoods and offenses and add to dataset
-data['Neighborhood'] = pd.Series(get_neighborhoods(data))
-data['Offense'] = pd.Series(get_offenses(data))
+    return max(1000, int(available / (row_bytes * chunk_overhead)))
 
-# Select only relevant columns
-columns_to_keep = ["ARREST_KEY", "ARREST_DATE", "PD_CD", "PD_DESC", "KY_CD", "OFNS_DESC", "LAW_CODE", "LAW_CAT_CD", "ARREST_BORO", "ARREST_PRECINCT", "JURISDICTION_CODE", "AGE_GROUP", "PERP_SEX", "PERP_RACE", "Latitude", "Longitude", "Community_District", "Police_Precinct", "City_Council_District", "Congressional_District", "State_Assembly_District", "State_Senate_District", "Zipcode", "Neighborhood"]
-current_columns = list(data.columns)
-data = data.drop(columns=[c for c in current_columns if c not in columns_to_keep])
 
-# Create specific time variables
-data["ARREST_QUARTER"] = pd.Series([(int(d.split("/")[0])-1)//3 for d in data["ARREST_DATE"].tolist()])
-data["ARREST_YEAR"] = pd.Series([int(d.split("/")[2]) for d in data["ARREST_DATE"].tolist()])
+# Add zones, neighborhoods, offenses and time variables to a chunk of new data
+def process_chunk(data):
+    # Fill any missing latitude and longitude values
+    data["Latitude"] = data["Latitude"].fillna(0)
+    data["Longitude"] = data["Longitude"].fillna(0)
 
-# Load old datafile and remove all data from current year
-    # The new file will always contain all data from the current year, with new quarters added periodically - thus we remove all existing data for the year
-old_data = pd.read_csv('arrest_data/' + current_data_file)
-old_data = old_data[old_data['ARREST_YEAR'] != current_year]
+    # Get coordinates for locating points geographically
+    x = data["Longitude"].to_numpy(dtype=float)
+    y = data["Latitude"].to_numpy(dtype=float)
 
-# Combine newly processed data with existing dataset
-complete_data = pd.concat([data, old_data])
+    # Find the zones of each type for every entry
+        # Zones are cached by coordinate pair, so geometry is only run for locations not seen in earlier runs
+    print("Loading zones...")
+    zone_values, zone_counts, cached = assign_zones_cached(layers, bounds_file, zone_cache, x, y, processes, grid_file)
+    print(str(cached) + " locations found in zone cache")
+
+    # Loop through data and add label for each new zone
+    for z in zones:
+        print(z + ": " + str(zone_counts[zones[z]]["grid"]) + " points found in zone grid, " + str(zone_counts[zones[z]]["exact"]) + " points tested against full shapes, " + str(zone_counts[zones[z]]["ambiguous"]) + " points in multiple zones, " + str(zone_counts[zones[z]]["unmatched"]) + " points outside every zone")
+
+        # Zone names are all numbers; store them as numbers to match existing data
+        data[z.replace(" ", "_")] = pd.to_numeric(zone_values[zones[z]]).astype(float)
+
+    # Get neighborhoods and offenses and add to dataset
+    data['Neighborhood'] = get_neighborhoods(data)
+    data['Offense'] = get_offenses(data)
+
+    # Select only relevant columns
+    data = data.drop(columns=[c for c in data.columns if c not in columns_to_keep])
+
+    # Create specific time variables
+    return add_time_columns(data)
+
+
+# Define zones to add to dataset
+zones = {"Community District": "cd", "Police Precinct": "pp", "City Council District": "cc", "Congressional District": "nycongress", "Zipcode": "zipcode", "State Assembly District": "sa", "State Senate District": "ss"}
+display = False
+
+# Load in geographic shapes for zones
+# Source: https://github.com/BetaNYC/nyc-boundaries.git
+df = load_bounds(zones.values(), bounds_file)
+
+# Define columns to keep in dataset
+columns_to_keep = ["ARREST_KEY", "ARREST_DATE", "PD_CD", "PD_DESC", "KY_CD", "OFNS_DESC", "LAW_CODE", "LAW_CAT_CD", "ARREST_BORO", "ARREST_PRECINCT", "JURISDICTION_CODE", "AGE_GROUP", "PERP_SEX", "PERP_RACE", "Latitude", "Longitude", "Community_District", "Police_Precinct", "City_Council_District", "Congressional_District", "State_Assembly_District", "State_Senate_District", "Zipcode", "Neighborhood", "Offense"]
+
+# Define column types when streaming, so every chunk is stored with the same types
+column_types = {"ARREST_DATE": str, "PD_CD": float, "PD_DESC": str, "KY_CD": float, "OFNS_DESC": str, "LAW_CODE": str, "LAW_CAT_CD": str, "ARREST_BORO": str, "ARREST_PRECINCT": float, "JURISDICTION_CODE": float, "AGE_GROUP": str, "PERP_SEX": str, "PERP_RACE": str, "Latitude": float, "Longitude": float}
+chunk_overhead = 8
+
+# Build spatial index over the polygons of each zone type
+layers = build_zone_layers(df, zones.values(), simplify_tolerance)
+
+if display:
+    for z in zones:
+        df[df["id"] == zones[z]].plot()
+        plt.show()
 
-# Save new file with all data
-complete_data.to_csv("arrest_data/arrest_data.csv", index=False)
\ No newline at end of file
+# Load grid of zones, built on first use and whenever the boundary file changes
+grid_file = None
+if use_zone_grid:
+    grid_file = "shapefiles/" + zone_grid_file
+    attach_zone_grid(layers, bounds_file, grid_file)
+
+# Move existing datafile into the arrest store, one file per year, if this has not been done yet
+if not stored_years() and os.path.exists('arrest_data/' + current_data_file):
+    old_data = pd.read_csv('arrest_data/' + current_data_file, low_memory=False)
+    # Add time variables missing from data processed before they were introduced
+    if "ARREST_MONTH" not in old_data.columns:
+        old_data = add_time_columns(old_data)
+    for year, year_data in old_data[old_data['ARREST_YEAR'] != current_year].groupby("ARREST_YEAR"):
+        write_year(year_data, year)
+    del old_data
+
+# Load zones found in earlier runs; the cache is kept in memory while processing and saved once at the end
+zone_cache = load_zone_cache('arrest_data/' + zone_cache_file, update_cache(bounds_file), zones.values())
+
+if memory_limit:
+    # Stream new dataset in chunks, writing each one out before reading the next
+        # Every year in the file is replaced, so historical bulk files can be loaded the same way
+        # Chunk size is worked out again for each chunk, as the zone cache grows
+    row_bytes = row_size('arrest_data/' + new_data_file)
+    writers = {}
+    start = 0
+
+    with pd.read_csv('arrest_data/' + new_data_file, dtype=column_types, iterator=True) as reader:
+        while True:
+            try:
+                chunk = reader.get_chunk(rows_per_chunk(row_bytes, memory_limit))
+            except StopIteration:
+                break
+            print("Processing rows " + str(start) + "-" + str(start + len(chunk.index) - 1) + "...")
+            append_years(writers, process_chunk(chunk))
+            start += len(chunk.index)
+
+    close_years(writers)
+    save_zone_cache('arrest_data/' + zone_cache_file, zone_cache)
+else:
+    # Load new dataset, and hash each record so changes since the last run can be found
+        # Columns are read with fixed types, so a missing value in a later release can't change how every earlier record hashes
+        # Only the columns that are stored are hashed; changes to other columns don't change the output
+    raw_data = pd.read_csv('arrest_data/' + new_data_file, dtype=column_types)
+
+    # Only the current year's file is replaced, so records from other years are left out rather than stored under the wrong year
+    in_year = arrest_years(raw_data) == current_year
+    if not in_year.all():
+        print("Skipping " + str(np.count_nonzero(~in_year)) + " records not from " + str(current_year) + "; set memory_limit to store every year in the file")
+        raw_data = raw_data[in_year].reset_index(drop=True)
+
+    hashed_columns = ["ARREST_KEY"] + list(column_types)
+    manifest = pd.DataFrame({"ARREST_KEY": raw_data["ARREST_KEY"].to_numpy(), "RECORD_HASH": pd.util.hash_pandas_object(raw_data[hashed_columns], index=False).to_numpy()})
+    source_hashes = {"bounds_hash": update_cache(bounds_file), "lookup_hash": lookup_hash()}
+
+    # Find records that are unchanged since the last run
+        # Only possible if the year has a manifest, records were processed with the same boundary file and lookup tables, and every ARREST_KEY is unique
+    old_manifest, old_source_hashes = read_manifest(current_year)
+    unchanged = np.zeros(len(raw_data.index), dtype=bool)
+    if use_delta and old_manifest is not None and old_source_hashes != source_hashes:
+        print("Boundary file or lookup tables changed since last run; processing every record")
+    elif use_delta and old_manifest is not None and manifest["ARREST_KEY"].is_unique:
+        unchanged = manifest.merge(old_manifest.drop_duplicates(), on=["ARREST_KEY", "RECORD_HASH"], how="left", indicator=True)["_merge"].eq("both").to_numpy()
+
+    # Keep stored entries for unchanged records; the stored data must hold every one of them
+    kept_data = None
+    if unchanged.any():
+        kept_data = read_arrests(years=[current_year])
+        kept_data = kept_data[kept_data["ARREST_KEY"].isin(manifest["ARREST_KEY"][unchanged])]
+        if len(kept_data.index) != np.count_nonzero(unchanged):
+            unchanged[:] = False
+            kept_data = None
+
+    deleted = 0 if old_manifest is None else np.count_nonzero(~old_manifest["ARREST_KEY"].isin(manifest["ARREST_KEY"]))
+    print(str(np.count_nonzero(unchanged)) + " records unchanged, " + str(np.count_nonzero(~unchanged)) + " new or revised, " + str(deleted) + " deleted since last run")
+
+    # Process new and revised records only
+    data = process_chunk(raw_data[~unchanged].copy())
+    if kept_data is not None:
+        data = pd.concat([kept_data, data], ignore_index=True)
+
+        # Put entries back in the order of the new file
+        order = pd.Series(np.arange(len(raw_data.index)), index=raw_data["ARREST_KEY"])
+        data = data.iloc[np.argsort(order[data["ARREST_KEY"]].to_numpy(), kind="stable")].reset_index(drop=True)
+
+    # Save data for the current year, replacing the data stored for the year
+        # The new file will always contain all data from the current year, with new quarters added periodically - other years are left untouched
+    write_year(data, current_year)
+    write_manifest(manifest, source_hashes, current_year)
+    save_zone_cache('arrest_data/' + zone_cache_file, zone_cache)
@@ -0,0 +1,106 @@
+import os
+import json
+import glob
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+"""
+Stores processed arrest data as one Parquet file per arrest year, so scripts only load the years and columns they need
+"""
+
+store_folder = "arrest_data/arrest_store"
+
+
+# Find the file holding arrest data for the given year
+def year_file(year, folder=store_folder):
+    return os.path.join(folder, "ARREST_YEAR=" + str(int(year)) + ".parquet")
+
+
+# Find the years with arrest data in the store
+def stored_years(folder=store_folder):
+    files = glob.glob(os.path.join(folder, "ARREST_YEAR=*.parquet"))
+    return sorted(int(os.path.basename(f)[len("ARREST_YEAR="):-len(".parquet")]) for f in files)
+
+
+# Find the size and modification time of each year's arrest data; used to tell which years changed since data built from the store was made
+def year_versions(folder=store_folder):
+    return {y: (os.stat(year_file(y, folder)).st_size, os.stat(year_file(y, folder)).st_mtime_ns) for y in stored_years(folder)}
+
+
+# Save arrest data for a year, replacing any data already stored for that year
+    # Written to a temporary file first so a failed run never leaves a partial year behind
+    # The year's manifest no longer describes the stored data, so it is removed; write_manifest saves a new one
+def write_year(data, year, folder=store_folder):
+    os.makedirs(folder, exist_ok=True)
+    path = year_file(year, folder)
+
+    data.to_parquet(path + ".tmp", index=False)
+    remove_manifest(year, folder)
+    os.replace(path + ".tmp", path)
+
+
+# Find the file holding the ARREST_KEY manifest for the given year
+def manifest_file(year, folder=store_folder):
+    return os.path.join(folder, "manifest_" + str(int(year)) + ".parquet")
+
+
+# Load the manifest of records stored for a year: the ARREST_KEY and a hash of the raw record, for each record
+    # Also returns the hashes (a dict) of the inputs the stored records were processed with; None if there is no manifest
+def read_manifest(year, folder=store_folder):
+    if not os.path.exists(manifest_file(year, folder)) or not os.path.exists(year_file(year, folder)):
+        return None, None
+
+    table = pq.read_table(manifest_file(year, folder))
+    source_hashes = table.schema.metadata.get(b"source_hashes")
+    return table.to_pandas(), None if source_hashes is None else json.loads(source_hashes)
+
+
+# Remove the manifest for a year, so the next run processes every record for it
+def remove_manifest(year, folder=store_folder):
+    if os.path.exists(manifest_file(year, folder)):
+        os.remove(manifest_file(year, folder))
+
+
+# Save the manifest of records stored for a year, along with the hashes (a dict) of the inputs its records were processed with
+def write_manifest(manifest, source_hashes, year, folder=store_folder):
+    table = pa.Table.from_pandas(manifest, preserve_index=False)
+    table = table.replace_schema_metadata({**table.schema.metadata, b"source_hashes": json.dumps(source_hashes).encode()})
+
+    pq.write_table(table, manifest_file(year, folder) + ".tmp")
+    os.replace(manifest_file(year, folder) + ".tmp", manifest_file(year, folder))
+
+
+# Add a chunk of arrest data to the files being written for the years it contains
+    # writers holds the open file for each year; files only replace stored data once close_years is called
+def append_years(writers, data, folder=store_folder):
+    for year, year_data in data.groupby("ARREST_YEAR"):
+        table = pa.Table.from_pandas(year_data, preserve_index=False)
+        # Columns with no values in this chunk hold text
+        table = table.cast(pa.schema([pa.field(f.name, pa.string()) if pa.types.is_null(f.type) else f for f in table.schema], metadata=table.schema.metadata))
+
+        if year not in writers:
+            os.makedirs(folder, exist_ok=True)
+            writers[year] = pq.ParquetWriter(year_file(year, folder) + ".tmp", table.schema)
+        writers[year].write_table(table.cast(writers[year].schema))
+
+
+# Finish writing files opened by append_years, replacing the data stored for each year
+    # Manifests of the replaced years are removed, as no manifest is kept for streamed data
+def close_years(writers, folder=store_folder):
+    for year in writers:
+        writers[year].close()
+        remove_manifest(year, folder)
+        os.replace(year_file(year, folder) + ".tmp", year_file(year, folder))
+
+
+# Load arrest data, optionally only for the given years and columns
+def read_arrests(columns=None, years=None, folder=store_folder):
+    if years is None:
+        years = stored_years(folder)
+
+    frames = [pd.read_parquet(year_file(y, folder), columns=columns) for y in years if os.path.exists(year_file(y, folder))]
+    if not frames:
+        raise FileNotFoundError("No arrest data stored in " + folder)
+
+    return pd.concat(frames, ignore_index=True)
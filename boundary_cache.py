@@ -0,0 +1,117 @@
+import os
+import json
+import hashlib
+import shapely
+import pandas as pd
+import geopandas as gpd
+
+"""
+Caches the zone polygons from the boundary files as one GeoParquet file per zone type, so scripts load them without parsing GeoJSON
+"""
+
+# Source: https://github.com/BetaNYC/nyc-boundaries.git
+all_bounds_file = "shapefiles/all_bounds.geojson"
+neighborhoods_file = "shapefiles/neighborhoods.geojson"
+cache_folder = "shapefiles/boundary_cache"
+
+# Projected coordinates used to draw maps (New York State Plane, Long Island, in feet)
+render_crs = "EPSG:2263"
+
+
+# Find the hash of a file; used to tell when data built from the file is out of date
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+
+    return h.hexdigest()
+
+
+# Find the cache file for a zone type from a boundary file
+def layer_file(source_file, layer_id):
+    return os.path.join(cache_folder, os.path.splitext(os.path.basename(source_file))[0] + "_" + layer_id + ".parquet")
+
+
+# Make sure the cache matches the current version of a boundary file, rebuilding it if not; returns the hash of the boundary file
+    # The boundary file is only re-hashed when its size or modification time change
+    # Files with an "id" column (like all_bounds.geojson) are split into one layer per id; other files are stored as a single "all" layer
+def update_cache(source_file):
+    info_file = os.path.join(cache_folder, os.path.basename(source_file) + ".json")
+    stat = os.stat(source_file)
+
+    info = {}
+    if os.path.exists(info_file):
+        with open(info_file) as f:
+            info = json.load(f)
+    layers_exist = "layers" in info and all(os.path.exists(layer_file(source_file, i)) for i in info["layers"])
+
+    if layers_exist and info.get("size") == stat.st_size and info.get("mtime") == stat.st_mtime_ns:
+        return info["source_hash"]
+
+    source_hash = file_hash(source_file)
+    if not layers_exist or info.get("source_hash") != source_hash:
+        shapes = gpd.read_file(source_file)
+        os.makedirs(cache_folder, exist_ok=True)
+
+        if "id" in shapes.columns:
+            layer_ids = shapes["id"].unique().tolist()
+            for i in layer_ids:
+                shapes[shapes["id"] == i].reset_index(drop=True).to_parquet(layer_file(source_file, i))
+        else:
+            layer_ids = ["all"]
+            shapes.to_parquet(layer_file(source_file, "all"))
+        info["layers"] = layer_ids
+
+    info.update({"size": stat.st_size, "mtime": stat.st_mtime_ns, "source_hash": source_hash})
+    with open(info_file, "w") as f:
+        json.dump(info, f)
+
+    return source_hash
+
+
+# Load the polygons for a zone type (an id in all_bounds.geojson, or "neighborhoods")
+def load_layer(layer_id, source_file=all_bounds_file):
+    if layer_id == "neighborhoods":
+        source_file, layer_id = neighborhoods_file, "all"
+    update_cache(source_file)
+
+    return gpd.read_parquet(layer_file(source_file, layer_id))
+
+
+# Load the polygons for several zone types together, in the same form as all_bounds.geojson
+def load_bounds(layer_ids, source_file=all_bounds_file):
+    return gpd.GeoDataFrame(pd.concat([load_layer(i, source_file) for i in layer_ids], ignore_index=True))
+
+
+# Load the polygons for a zone type simplified for drawing maps, in projected coordinates (render_crs)
+    # The tolerance is half the distance a pixel covers when the layer fills a figure_size-inch figure at dpi, so the simplification can't be seen
+    # Zones that form a valid coverage (no overlaps or gaps between neighbors) are simplified together where shapely supports it, so neighboring zones keep matching edges
+    # Coverage simplification (Visvalingam-Whyatt) treats the tolerance as roughly the square root of the area of each triangle removed, not a distance, so it is only close to the pixel limit
+    # Otherwise each zone is simplified on its own (Douglas-Peucker, where the tolerance is a distance), keeping its own topology
+    # Cached until the boundary file or any of the settings change
+def load_render_layer(layer_id, figure_size=10, dpi=300, source_file=all_bounds_file):
+    if layer_id == "neighborhoods":
+        source_file, layer_id = neighborhoods_file, "all"
+    settings = {"source_hash": update_cache(source_file), "crs": render_crs, "figure_size": figure_size, "dpi": dpi}
+
+    path = layer_file(source_file, layer_id + "_render")
+    if os.path.exists(path) and os.path.exists(path + ".json"):
+        with open(path + ".json") as f:
+            if json.load(f) == settings:
+                return gpd.read_parquet(path)
+
+    shapes = gpd.read_parquet(layer_file(source_file, layer_id)).to_crs(render_crs)
+    bounds = shapes.total_bounds
+    tolerance = max(bounds[2] - bounds[0], bounds[3] - bounds[1]) / (figure_size * dpi) / 2
+
+    if hasattr(shapely, "coverage_simplify") and shapely.coverage_is_valid(shapes.geometry.values):
+        shapes[shapes.geometry.name] = shapely.coverage_simplify(shapes.geometry.values, tolerance)
+    else:
+        shapes[shapes.geometry.name] = shapes.geometry.simplify(tolerance, preserve_topology=True)
+
+    shapes.to_parquet(path)
+    with open(path + ".json", "w") as f:
+        json.dump(settings, f)
+
+    return shapes
@@ -0,0 +1,213 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+from arrest_store import read_arrests, year_versions
+
+"""
+Stores arrest counts by zone, year, quarter, offense, age group, race and sex as memory-mapped NumPy arrays (one per zone type), so scripts can answer count queries without loading arrest records
+"""
+
+cube_folder = "arrest_data/count_cube"
+
+# Zone types with a cube; "All" has a single zone covering every arrest, including those outside any zone
+zone_types = ["All", "Community_District", "Police_Precinct", "City_Council_District", "Congressional_District", "Zipcode", "State_Assembly_District", "State_Senate_District", "Neighborhood"]
+count_columns = ["ARREST_YEAR", "ARREST_QUARTER", "Offense", "AGE_GROUP", "PERP_RACE", "PERP_SEX"]
+
+# Age groups used by the data; anything else (mistyped ages, missing values) is counted as "UNKNOWN"
+age_groups = ["<18", "18-24", "25-44", "45-64", "65+"]
+
+
+# Find the file holding the cube for a zone type
+def cube_file(zone_type):
+    return os.path.join(cube_folder, zone_type.lower() + ".npy")
+
+
+# Read the columns counted in the cubes for the given years (every stored year if None), counting unexpected age groups as "UNKNOWN"
+def read_cube_data(years=None):
+    data = read_arrests(columns=count_columns + zone_types[1:], years=years)
+    data["AGE_GROUP"] = data["AGE_GROUP"].where(data["AGE_GROUP"].isin(age_groups), "UNKNOWN")
+
+    return data
+
+
+# Find the sorted labels along each axis of the cubes from arrest data
+    # Missing values are kept as their own label in counted columns, but are not a zone
+def find_labels(data):
+    labels = {"All": ["All"]}
+    for c in count_columns:
+        labels[c] = np.asarray(pd.factorize(data[c], sort=True, use_na_sentinel=False)[1]).tolist()
+    for z in zone_types[1:]:
+        labels[z] = np.asarray(pd.factorize(data[z], sort=True)[1]).tolist()
+
+    return labels
+
+
+# Encode a column as positions in its labels; missing values take the position of the missing label, or -1 if there isn't one
+    # Returns None if the column has a value (other than a missing value) not in the labels
+def encode_column(values, labels):
+    codes = pd.Index(labels).get_indexer(values)
+    missing = pd.isna(values).to_numpy()
+    codes[missing] = next((i for i, label in enumerate(labels) if pd.isna(label)), -1)
+
+    if (codes[~missing] == -1).any():
+        return None
+    return codes
+
+
+# Encode every column of arrest data as positions in the labels along each axis; returns None if the data has a label not in labels
+    # Arrests with a missing zone are encoded as -1 for that zone type, and are not counted in its cube
+def encode(data, labels):
+    codes = {"All": np.zeros(len(data.index), np.int64)}
+    for c in count_columns + zone_types[1:]:
+        codes[c] = encode_column(data[c], labels[c])
+        if codes[c] is None or (c in count_columns and (codes[c] == -1).any()):
+            return None
+
+    return codes
+
+
+# Count the arrests in each zone and combination of the other columns for the given rows (one year of arrest data)
+def count_year(rows, zone_codes, n_zones, rest_index, rest_size):
+    rows = rows[zone_codes[rows] >= 0]
+
+    return np.bincount(zone_codes[rows] * rest_size + rest_index[rows], minlength=n_zones * rest_size)
+
+
+# Write the cube for each zone type from encoded arrest data, returning the labels along each axis of each cube
+    # Years in copied (a dict of year to its position in the existing cubes) are copied from the existing cubes, which must have the same labels on every other axis; all other years are counted
+    # Each cube is written one year at a time to a memory-mapped file, using the smallest of uint16 and uint32 that holds its largest count
+def write_cubes(codes, labels, copied=None):
+    copied = copied or {}
+
+    # Combine every column other than year into a single index; years are counted separately
+    rest = ["ARREST_QUARTER"] + count_columns[2:]
+    rest_shape = [len(labels[c]) for c in rest]
+    rest_index = np.ravel_multi_index([codes[c] for c in rest], rest_shape)
+    rest_size = int(np.prod(rest_shape))
+
+    years = labels["ARREST_YEAR"]
+    year_order = np.argsort(codes["ARREST_YEAR"], kind="stable")
+    year_rows = np.split(year_order, np.cumsum(np.bincount(codes["ARREST_YEAR"], minlength=len(years)))[:-1])
+
+    os.makedirs(cube_folder, exist_ok=True)
+    axes = {}
+    for z in zone_types:
+        zone_codes, zone_labels = codes[z], labels[z]
+        old_cube = np.load(cube_file(z), mmap_mode="r") if copied else None
+
+        # Find the largest count first, so the cube can use the smallest type that holds it; years are counted again as they are written
+        max_count = max([int(count_year(rows, zone_codes, len(zone_labels), rest_index, rest_size).max(initial=0)) for y, rows in enumerate(year_rows) if years[y] not in copied] +
+                        [int(old_cube[:, copied[years[y]]].max(initial=0)) for y in range(len(years)) if years[y] in copied], default=0)
+        dtype = np.uint16 if max_count <= np.iinfo(np.uint16).max else np.uint32
+
+        shape = (len(zone_labels), len(years), *rest_shape)
+        cube = np.lib.format.open_memmap(cube_file(z) + ".tmp", mode="w+", dtype=dtype, shape=shape)
+        for y, rows in enumerate(year_rows):
+            if years[y] in copied:
+                cube[:, y] = old_cube[:, copied[years[y]]]
+            else:
+                cube[:, y] = count_year(rows, zone_codes, len(zone_labels), rest_index, rest_size).reshape(len(zone_labels), *rest_shape)
+        cube.flush()
+        del cube, old_cube
+        os.replace(cube_file(z) + ".tmp", cube_file(z))
+
+        axes[z] = [[z, zone_labels]] + [[c, labels[c]] for c in count_columns]
+
+    return axes
+
+
+# Make sure the cubes match the arrest data currently stored, updating them if not; returns the labels along each axis of each cube
+    # Only the years whose stored data changed are read and recounted, and the counts for every other year are copied from the existing cubes
+    # The cubes are rebuilt from every stored year if they are missing, or if a changed year has a label (ie a new offense or zone) not already in the cubes
+def update_cubes():
+    info_file = os.path.join(cube_folder, "info.json")
+    versions = [[y, *v] for y, v in sorted(year_versions().items())]
+
+    info = {}
+    if os.path.exists(info_file) and all(os.path.exists(cube_file(z)) for z in zone_types):
+        with open(info_file) as f:
+            info = json.load(f)
+    if info.get("versions") == versions:
+        return info["axes"]
+
+    # Drop the saved labels while the cubes are written, so a run that stops part way rebuilds every cube next time
+    if os.path.exists(info_file):
+        os.remove(info_file)
+
+    axes = None
+    if info:
+        # Keep the years whose stored data is unchanged (and still stored), and recount the rest
+        stored = {v[0]: v[1:] for v in info["versions"]}
+        current = {v[0]: v[1:] for v in versions}
+        changed = [y for y in current if stored.get(y) != current[y]]
+        old_years = dict(info["axes"]["All"])["ARREST_YEAR"]
+        kept = [y for y in old_years if y in current and y not in changed]
+
+        print("Updating count cubes for " + ", ".join(str(y) for y in sorted(set(changed) | (set(old_years) - set(current)))) + "...")
+        data = read_cube_data(changed) if changed else pd.DataFrame(columns=count_columns + zone_types[1:])
+
+        # Labels along every other axis are the labels already in the cubes
+        labels = {z: info["axes"][z][0][1] for z in zone_types}
+        labels.update(dict(info["axes"]["All"][1:]))
+        labels["ARREST_YEAR"] = sorted(set(kept) | set(data["ARREST_YEAR"].unique().tolist()))
+
+        codes = encode(data, labels)
+        if codes is not None:
+            axes = write_cubes(codes, labels, {y: old_years.index(y) for y in kept})
+        del data
+
+    if axes is None:
+        print("Building count cubes...")
+        data = read_cube_data()
+        labels = find_labels(data)
+        axes = write_cubes(encode(data, labels), labels)
+        del data
+
+    with open(info_file, "w") as f:
+        json.dump({"versions": versions, "axes": axes}, f)
+
+    return axes
+
+
+# Load the cube for a zone type (read-only, memory-mapped) along with the labels along each of its axes
+def load_cube(zone_type):
+    axes = update_cubes()[zone_type]
+
+    return np.load(cube_file(zone_type), mmap_mode="r"), dict(axes)
+
+
+# Find the labels along one axis of the cube for a zone type (ie the years in the data)
+def cube_labels(zone_type, axis):
+    return load_cube(zone_type)[1][axis]
+
+
+# Count arrests for a zone type, summing over every axis not in keep
+    # select limits an axis to a label or list of labels (ie Neighborhood="Northeast Bronx", ARREST_YEAR=[2021, 2022]); labels not in the data count as zero
+    # Returns a single count if keep is empty, otherwise a Series of counts indexed by the kept axes (in cube order), skipping missing labels as groupby does
+def query(zone_type, keep=(), **select):
+    counts, axes = load_cube(zone_type)
+    names = list(axes)
+
+    labels = []
+    for i, name in enumerate(names):
+        if name in select:
+            wanted = select[name] if isinstance(select[name], list) else [select[name]]
+            at = [axes[name].index(v) for v in wanted if v in axes[name]]
+            counts = np.take(counts, at, axis=i)
+            labels.append([axes[name][j] for j in at])
+        else:
+            labels.append(axes[name])
+
+    counts = counts.sum(axis=tuple(i for i, name in enumerate(names) if name not in keep), dtype=np.int64)
+    if not keep:
+        return int(counts)
+
+    kept = [i for i, name in enumerate(names) if name in keep]
+    if len(kept) == 1:
+        index = pd.Index(labels[kept[0]], name=names[kept[0]])
+    else:
+        index = pd.MultiIndex.from_product([labels[i] for i in kept], names=[names[i] for i in kept])
+    result = pd.Series(counts.ravel(), index=index)
+
+    return result[index.to_frame().notna().all(axis=1).to_numpy()]
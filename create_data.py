@@ -1,6 +1,10 @@
+import os
 import numpy as np
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import matplotlib.pyplot as plt
+from arrest_store import read_arrests, year_versions
 
 """
 Creates files for each zone type with arrest information by quarter and year; used for later data production scripts
@@ -18,17 +22,202 @@ def plot_by_time(data, key, title):
     plt.savefig("figures/arrests_by_" + title.lower() + ".png", bbox_inches = 'tight', dpi=300)
     plt.close()
 
+# Run a function for each zone type, across a pool of processes if processes is more than 1
+    # Workers are forked, so they share the data already loaded (ie count_data) instead of each receiving a copy
+    # A zone type that fails is reported and skipped; returns the results for the others and the zone types that failed
+    # Runs in one process where fork is not available (ie Windows)
+def run_by_zone(function, zones):
+    results, failed = {}, []
+
+    parallel = processes > 1 and "fork" in multiprocessing.get_all_start_methods()
+    if processes > 1 and not parallel:
+        print("Parallel processing needs the fork start method, which this platform does not have; running in one process")
+
+    if parallel:
+        with ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context("fork")) as pool:
+            futures = {z: pool.submit(function, z) for z in zones}
+    else:
+        futures = None
+
+    for z in zones:
+        try:
+            results[z] = function(z) if futures is None else futures[z].result()
+        except Exception as e:
+            print("Failed to process " + z + ": " + repr(e))
+            failed.append(z)
+
+    return results, failed
+
+# Count arrests in every zone of a zone type in every quarter, encoding the zone column as integers and counting with bincount
+    # Uses the data and periods set by count_arrests
+def count_zone(z):
+    data, periods, n_years = count_data
+    codes, names = pd.factorize(data[z])
+    names = np.asarray(names)
+    keep = codes >= 0
+
+    counts = np.bincount(codes[keep] * n_years * 4 + periods[keep], minlength=len(names) * n_years * 4).reshape(len(names), n_years, 4)
+    order = np.argsort(names, kind="stable")
+
+    return names[order], counts[order]
+
+# Count arrests in every zone of every zone type in every quarter
+    # Each zone column is read once; arrests by year are found later by summing quarters rather than recounting the data
+    # Returns the years in the data, arrests in each quarter of each year, and for each zone type its zones (sorted) and their arrests in each quarter of each year; also returns the zone types that could not be counted
+def count_arrests(data, zones):
+    global count_data
+    years = np.sort(data["ARREST_YEAR"].unique())
+    periods = np.searchsorted(years, data["ARREST_YEAR"].to_numpy()) * 4 + data["ARREST_QUARTER"].to_numpy().astype(np.int64)
+    totals = np.bincount(periods, minlength=len(years) * 4).reshape(len(years), 4)
+
+    count_data = (data, periods, len(years))
+    zone_counts, failed = run_by_zone(count_zone, zones)
+    count_data = None
+
+    return (years, totals, zone_counts), failed
+
+# Replace the counts for some years in stored counts (as returned by count_arrests) with new counts; new is None if there is no new data for those years
+    # Zones only found in the replaced years are dropped, so the result matches counting all the data at once
+def merge_counts(old, new, replaced_years):
+    old_years, old_totals, old_zone_counts = old
+    kept = ~np.isin(old_years, replaced_years)
+    years = old_years[kept] if new is None else np.union1d(old_years[kept], new[0])
+    old_at = np.searchsorted(years, old_years[kept])
+
+    totals = np.zeros((len(years), 4), old_totals.dtype)
+    totals[old_at] = old_totals[kept]
+    if new is not None:
+        new_at = np.searchsorted(years, new[0])
+        totals[new_at] = new[1]
+
+    zone_counts = {}
+    for z in old_zone_counts:
+        old_names, old_counts = old_zone_counts[z]
+        names = old_names if new is None else np.unique(np.concatenate([old_names, new[2][z][0]]))
+
+        counts = np.zeros((len(names), len(years), 4), old_counts.dtype)
+        counts[np.ix_(np.searchsorted(names, old_names), old_at)] = old_counts[:, kept]
+        if new is not None:
+            counts[np.ix_(np.searchsorted(names, new[2][z][0]), new_at)] = new[2][z][1]
+
+        seen = counts.sum(axis=(1, 2)) > 0
+        zone_counts[z] = (names[seen], counts[seen])
+
+    return years, totals, zone_counts
+
+# Count arrests in each zone type, year and quarter, only recounting the years whose arrest data changed since counts were last stored
+    # Counts all the data if there are no stored counts, they were made for different zone types, or incremental is False
+    # Returns the counts and the zone types that could not be counted; counts are only stored once every zone type is counted
+def load_counts(zones):
+    versions = year_versions()
+    columns = ["ARREST_YEAR", "ARREST_QUARTER"] + zones
+
+    stored = None
+    if incremental and os.path.exists(counts_file):
+        stored = pd.read_pickle(counts_file)
+
+    if stored is None or stored["zones"] != zones:
+        print("Counting arrests...")
+        counts, failed = count_arrests(read_arrests(columns=columns), zones)
+    else:
+        changed = [y for y in versions if stored["versions"].get(y) != versions[y]]
+        removed = [y for y in stored["versions"] if y not in versions]
+        counts, failed = stored["counts"], []
+
+        if changed or removed:
+            print("Recounting arrests for " + ", ".join(str(y) for y in changed + removed) + "...")
+            new = None
+            if changed:
+                new, failed = count_arrests(read_arrests(columns=columns, years=changed), zones)
+                counts = (counts[0], counts[1], {z: counts[2][z] for z in zones if z not in failed})
+            counts = merge_counts(counts, new, changed + removed)
+
+    if not failed:
+        pd.to_pickle({"zones": zones, "versions": versions, "counts": counts}, counts_file)
+
+    return counts, failed
+
+# Build the quarterly and yearly data for a zone type from its counts
+    # Adds in zeros for any combination of zone, year and quarter found in the data but missing for a zone; quarters after new_quarter are not expected in new_year
+def zone_frames(z, names, counts, years):
+    seen_years = counts.sum(axis=(0, 2)) > 0
+    seen_quarters = counts.sum(axis=(0, 1)) > 0
+    expected = (years != new_year)[:, None] | (np.arange(4) <= new_quarter)[None, :]
+    quarter_rows = (seen_years[:, None] & seen_quarters[None, :] & expected)[None, :, :] | (counts > 0)
+    year_rows = np.broadcast_to(seen_years, counts.shape[:2])
+
+    # Remove all data for certain districts; no corresponding census data available for these areas
+    if z == "Neighborhood":
+        counts = counts.copy()
+        counts[np.isin(names, no_census_neighborhoods)] = 0
+
+    zone_i, year_i, quarter = np.nonzero(quarter_rows)
+    by_quarter = pd.DataFrame({z: names[zone_i], "ARREST_YEAR": years[year_i], "ARREST_QUARTER": quarter, "#_ARRESTS": counts[quarter_rows]})
+    zone_i, year_i = np.nonzero(year_rows)
+    by_year = pd.DataFrame({z: names[zone_i], "ARREST_YEAR": years[year_i], "#_ARRESTS": counts.sum(axis=2)[year_rows]})
+
+    return by_quarter, by_year
+
+# Add the percent change in arrests from the previous period (quarter or year) for each zone
+    # Rows must be sorted by the key columns with no periods missing, as returned by zone_frames
+    # There is no change for the first period in the dataset (2006, or its first quarter); a change from zero arrests is 0 if there are still none, otherwise 100
+def add_changes(z_df, keys):
+    current = z_df["#_ARRESTS"]
+    old = z_df.groupby(keys[0], observed=True, sort=False)["#_ARRESTS"].shift(1)
+
+    first = z_df["ARREST_YEAR"] == 2006
+    if "ARREST_QUARTER" in keys:
+        first &= z_df["ARREST_QUARTER"] == 0
+    if (old.isna() & ~first).any():
+        raise ValueError("Previous period missing for some zones in " + keys[0] + " data")
+
+    change = ((current-old)/old)*100
+    change[old == 0] = np.where(current[old == 0] == 0, 0, 100)
+    change[first] = np.nan
+
+    return z_df.assign(ARREST_CHANGE=change)
+
+# Produce and save the quarterly and yearly data for a zone type, from the counts in zone_counts
+def produce_zone(z):
+    print("Producing quarterly data for " + z + "...")
+    by_quarter, by_year = zone_frames(z, *zone_counts[z], years)
+
+    # Find the percent change in arrests between each quarter
+    by_quarter = add_changes(by_quarter, [z, "ARREST_YEAR", "ARREST_QUARTER"])
+
+    # Save data by quarter
+    by_quarter.to_csv("arrest_data/increase_by_zone/" + z.lower() + "_increase_by_quarter.csv", index=False)
+
+    print("Producing yearly data for " + z + "...")
+    # Find the percent change in arrests between each year
+    by_year = add_changes(by_year, [z, "ARREST_YEAR"])
+
+    # Save data by year
+    by_year.to_csv("arrest_data/increase_by_zone/" + z.lower() + "_increase_by_year.csv", index=False)
+
 # UPDATE THESE
 new_year = 2023
 new_quarter = 1
 
+# Only recount arrests for years whose data changed since the last run (stored in counts_file)
+incremental = True
+counts_file = "arrest_data/zone_counts.pkl"
+
+# Number of processes used to count and produce data for zone types in parallel (1 processes them one after another)
+    # Above 1 needs the fork start method, so is only supported on Linux
+processes = 1
+count_data = None
+
 # Define zones to produce data files for
 zones = ["Community_District", "Police_Precinct", "City_Council_District", "Congressional_District", "Zipcode", "State_Assembly_District", "State_Senate_District", "Neighborhood"]
+# Define neighborhoods with no corresponding census data
+no_census_neighborhoods = ['Central Park', 'Laguardia Airport', 'JFK Airport']
 
-data = pd.read_csv('arrest_data/arrest_data.csv', low_memory=False)
+# Count arrests in each zone type, year and quarter
+(years, totals, zone_counts), failed = load_counts(zones)
 
 # Find arrests by year
-data_by_year = data.groupby(["ARREST_YEAR"])["ARREST_KEY"].size().reset_index(name = "COUNT")
+data_by_year = pd.DataFrame({"ARREST_YEAR": years, "COUNT": totals.sum(axis=1)})
 # Remove data for incomplete year
 data_by_year = data_by_year[data_by_year["ARREST_YEAR"] != new_year]
 
@@ -36,146 +225,15 @@ data_by_year = data_by_year[data_by_year["ARREST_YEAR"] != new_year]
 plot_by_time(data_by_year, "ARREST_YEAR", 'Year')
 
 # Fine arrests by quarter
-data_by_quarter = data.groupby(["ARREST_YEAR", "ARREST_QUARTER"])["ARREST_KEY"].size().reset_index(name = "COUNT")
+year_i, quarter = np.nonzero(totals)
+data_by_quarter = pd.DataFrame({"ARREST_YEAR": years[year_i], "ARREST_QUARTER": quarter, "COUNT": totals[year_i, quarter]})
 # Create key to use for plotting arrests by quarter
 data_by_quarter["TIME_KEY"] = pd.Series([str(row["ARREST_YEAR"]) + " – " + str(row["ARREST_QUARTER"]) for index, row in data_by_quarter.iterrows()])
 
 # Plot arrests by year
 plot_by_time(data_by_quarter, "TIME_KEY", 'Quarter')
 
-# Loop through each zone type
-for z in zones:
-    print("Producing quarterly data for " + z + "...")
-    # Count arrests in each zone in each quarter
-    z_df = data[data[z].notna()]
-    z_df = z_df.groupby([z, "ARREST_YEAR", "ARREST_QUARTER"])["ARREST_KEY"].size().reset_index(name = "#_ARRESTS")
-    
-    years = z_df["ARREST_YEAR"].unique().tolist()
-    years.sort()
-    quarters = z_df["ARREST_QUARTER"].unique().tolist()
-    quarters.sort()
-
-    # Remove all data for certain districts; no corresponding census data available for these areas
-    if z == "Neighborhood":
-        for n in ['Central Park', 'Laguardia Airport', 'JFK Airport']:
-            for y in years:
-                for q in quarters:
-                    z_df.loc[(z_df["Neighborhood"] == n) & (z_df["ARREST_YEAR"] == y) & (z_df["ARREST_QUARTER"] == q), "#_ARRESTS"] = 0
-    
-    # Loop through each zone (ie each zipcode)
-    # Add in missing data values – specfically adds in zeros for any combination of year and quarter expected but missing from dataset
-    for zone in z_df[z].unique().tolist():
-        zone_df = z_df[z_df[z] == zone]
-    
-        for y in years:
-            if not y in zone_df["ARREST_YEAR"].unique().tolist():
-                # Adds mising years
-                rows = []
-                for q in quarters:
-                    if (not y == new_year) or (y == new_year and q <= new_quarter):
-                        new_row = {z: zone, "ARREST_YEAR": y, "ARREST_QUARTER": q, "#_ARRESTS": 0}
-                        rows.append(new_row)
-                rows = pd.DataFrame(rows)
-                z_df = pd.concat([z_df, rows], axis=0, ignore_index=True)
-            else:
-                # Adds missing quarters
-                zone_year_df = zone_df[zone_df["ARREST_YEAR"] == y]
-                for q in quarters:
-                    if not q in zone_year_df["ARREST_QUARTER"].unique().tolist():
-                        if (not y == new_year) or (y == new_year and q <= new_quarter):
-                            new_row = {z: zone, "ARREST_YEAR": y, "ARREST_QUARTER": q, "#_ARRESTS": 0}
-                            new_row = pd.DataFrame([new_row])
-                            z_df = pd.concat([z_df, new_row], axis=0, ignore_index=True)
-
-    
-    # Find the percent change in arrests between each quarter
-    changes = []
-    
-    for index, row in z_df.iterrows():
-        current = row["#_ARRESTS"]
-
-        # Zero out values for first quarter in dataset
-        if row["ARREST_YEAR"] == 2006 and row["ARREST_QUARTER"] == 0:
-            change = None
-        else:
-            # Find last quarter's data
-            old_year = row["ARREST_YEAR"]
-            old_quarter = row["ARREST_QUARTER"]
-
-            if old_quarter == 0:
-                old_year = old_year - 1
-                old_quarter = 3
-            else:
-                old_quarter = old_quarter - 1
-            
-            old = z_df.loc[(z_df[z] == row[z]) & (z_df["ARREST_YEAR"] == old_year) & (z_df["ARREST_QUARTER"] == old_quarter)]["#_ARRESTS"].tolist()[0]
-
-            # Calculate percent change in arrests
-            if old == 0:
-                if current == 0:
-                    change = 0
-                else:
-                    change = 100
-            else:
-                change = ((current-old)/old)*100
-        
-        changes.append(change)
-    
-    # Save data by quarter
-    z_df["ARREST_CHANGE"] = pd.Series(changes)
-    z_df.sort_values(by=[z, "ARREST_YEAR", "ARREST_QUARTER"])
-    z_df.to_csv("arrest_data/increase_by_zone/" + z.lower() + "_increase_by_quarter.csv", index=False)
-
-    print("Producing yearly data for " + z + "...")
-    # Count arrests in each zone in each year
-    z_df = data[data[z].notna()]
-    z_df = z_df.groupby([z, "ARREST_YEAR"])["ARREST_KEY"].size().reset_index(name = "#_ARRESTS")
-
-    years = z_df["ARREST_YEAR"].unique().tolist()
-    years.sort()
-
-    # Remove all data for certain districts; no corresponding census data available for these areas
-    if z == "Neighborhood":
-        for n in ['Central Park', 'Laguardia Airport', 'JFK Airport']:
-            for y in years:
-                z_df.loc[(z_df["Neighborhood"] == n) & (z_df["ARREST_YEAR"] == y), "#_ARRESTS"] = 0
-    
-    # Loop through each zone (ie each zipcode)
-    # Add in missing data values – specfically adds in zeros for any combination of year expected but missing from dataset
-    for zone in z_df[z].unique().tolist():
-        zone_df = z_df[z_df[z] == zone]
-    
-        for y in years:
-            if not y in zone_df["ARREST_YEAR"].unique().tolist():
-                new_row = {z: zone, "ARREST_YEAR": y, "#_ARRESTS": 0}
-                new_row = pd.DataFrame([new_row])
-                z_df = pd.concat([z_df, new_row], axis=0, ignore_index=True)
-        
-    # Find the percent change in arrests between each year
-    changes = []
-    
-    for index, row in z_df.iterrows():
-        current = row["#_ARRESTS"]
-
-        # Zero out values for first year in dataset
-        if row["ARREST_YEAR"] == 2006:
-            change = None
-        else:
-            # Find last year's data
-            old = z_df.loc[(z_df[z] == row[z]) & (z_df["ARREST_YEAR"] == row["ARREST_YEAR"]-1)]["#_ARRESTS"].tolist()[0]
-
-            # Calculate percent change in arrests
-            if old == 0:
-                if current == 0:
-                    change = 0
-                else:
-                    change = 100
-            else:
-                change = ((current-old)/old)*100
-        
-        changes.append(change)
-    
-    # Save data by year
-    z_df["ARREST_CHANGE"] = pd.Series(changes)
-    z_df.sort_values(by=[z, "ARREST_YEAR"])
-    z_df.to_csv("arrest_data/increase_by_zone/" + z.lower() + "_increase_by_year.csv", index=False)
+# Produce data for each zone type
+failed += run_by_zone(produce_zone, list(zone_counts))[1]
+if failed:
+    raise RuntimeError("Could not produce data for " + ", ".join(failed))
@@ -1,27 +1,69 @@
 import os
+import numpy as np
 import pandas as pd
-from PIL import Image
-import geopandas as gpd
+from PIL import Image, GifImagePlugin
+import matplotlib
 import matplotlib.pyplot as plt
+from matplotlib.path import Path
+from matplotlib.transforms import BboxTransformTo
+from matplotlib.cm import ScalarMappable
+from matplotlib.patches import PathPatch
+from matplotlib.collections import PatchCollection
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from boundary_cache import load_render_layer
+from population_index import load_population_index, arrests_by_pop
 
 """
 Create figures and gifs displaying interesting data
 """
 
-# Delete images in given folder – used to clean images created for gifs
-def delete_images(img_folder):
-    for img in img_folder:
-        os.remove(img)
+# Build the palette shared by every frame of a gif: evenly spaced grays (including the white background and black text), then colors along the map's color map
+def gif_palette(cmap):
+    grays = np.repeat(np.linspace(0, 1, gif_grays)[:, None], 3, axis=1)
+    colors = plt.get_cmap(cmap)(np.linspace(0, 1, 256 - gif_grays))[:, :3]
 
-# Create gif from list of images
-def make_gif(frame_list, path):
-    frames = [Image.open(image) for image in frame_list]
-    frame_one = frames[0]
-    frame_one.save(path, format="GIF", append_images=frames,
-               save_all=True, duration=1000, loop=0)
+    palette = Image.new("P", (1, 1))
+    palette.putpalette((np.concatenate([grays, colors]) * 255).round().astype(np.uint8).tobytes())
+    return palette
 
-# Create figure and save given: population or area, specific or general
-def create_map(mode, merged, vmin, vmax, output_path, t, frame_mode):
+# Create gif from frames (image arrays, in order), writing each frame to the file as it arrives
+    # Every frame is mapped to one fixed palette, built from the map's color map (cmap)
+    # Written to a temporary file first, which is removed if anything fails, so a failed run never leaves a partial gif behind
+def make_gif(frames, path, cmap):
+    palette = gif_palette(cmap)
+    size = None
+
+    try:
+        with open(path + ".tmp", "wb") as f:
+            for frame in frames:
+                frame = Image.fromarray(frame).convert("RGB")
+                if size is not None and frame.size != size:
+                    # Keep every frame the size of the first
+                    canvas = Image.new("RGB", size, "white")
+                    canvas.paste(frame)
+                    frame = canvas
+                frame = frame.quantize(palette=palette, dither=Image.Dither.NONE)
+
+                if size is None:
+                    size = frame.size
+                    header, _ = GifImagePlugin.getheader(frame, info={"duration": 1000, "loop": 0})
+                    f.write(b"".join(header))
+                f.write(b"".join(GifImagePlugin.getdata(frame, duration=1000)))
+
+            if size is None:
+                raise ValueError("No frames to make " + path + " from")
+            f.write(b";")
+
+        os.replace(path + ".tmp", path)
+    except BaseException:
+        if os.path.exists(path + ".tmp"):
+            os.remove(path + ".tmp")
+        raise
+
+# Find the column, color map, title, and file suffix for a map given: population or area, specific or general
+def map_style(mode, frame_mode):
     # Create values based on mode
     if 'pop' in mode:
         column = "ARRESTS_BY_POP"
@@ -36,29 +78,163 @@ def create_map(mode, merged, vmin, vmax, output_path, t, frame_mode):
     
     if 'specific' in mode:
         suffix = suffix + '_SPECIFIC_' + frame_mode.upper()
-    
-    # Create map given specifications
-    fig = merged.plot(column = column, cmap=cmap, figsize=(10,10), legend=True, vmin=vmin, vmax=vmax, norm=plt.Normalize(vmin=vmin, vmax=vmax))
-    fig.axis('off')
-    fig.set_title(title, fontdict={'fontsize': '25', 'fontweight' : '3'})
-    time_label = str(t)
-    fig.annotate(time_label,
+
+    return column, cmap, title, suffix
+
+# Convert a polygon (with any holes) to a patch that matplotlib can draw
+def polygon_patch(polygon):
+    path = Path.make_compound_path(Path(np.asarray(polygon.exterior.coords)[:, :2]), *[Path(np.asarray(ring.coords)[:, :2]) for ring in polygon.interiors])
+    return PathPatch(path)
+
+# Create the figure for a map once – polygons, color bar, title, and time label – so each frame only has to recolor it with draw_map
+    # Draws the polygons in layer; multipolygons are split into one patch per polygon
+def build_map(mode, layer, vmin, vmax, frame_mode):
+    column, cmap, title, suffix = map_style(mode, frame_mode)
+    norm = plt.Normalize(vmin=vmin, vmax=vmax)
+    fig, ax = plt.subplots(figsize=(10,10), dpi=300)
+
+    # Scale axes the way GeoDataFrame.plot does
+    if layer.crs is not None and layer.crs.is_geographic:
+        bounds = layer.total_bounds
+        ax.set_aspect(1 / np.cos(np.mean([bounds[1], bounds[3]]) * np.pi / 180))
+    else:
+        ax.set_aspect('equal')
+
+    # Add polygons, keeping track of the row of layer each patch came from
+    patches, patch_rows = [], []
+    for i, geom in enumerate(layer.geometry):
+        if geom is None or geom.is_empty:
+            continue
+        for polygon in getattr(geom, "geoms", [geom]):
+            patches.append(polygon_patch(polygon))
+            patch_rows.append(i)
+    collection = PatchCollection(patches, cmap=cmap, norm=norm)
+    ax.add_collection(collection, autolim=True)
+    ax.autoscale_view()
+
+    legend = ScalarMappable(norm=norm, cmap=cmap)
+    legend.set_array(np.array([]))
+    fig.colorbar(legend, ax=ax)
+
+    ax.axis('off')
+    ax.set_title(title, fontdict={'fontsize': '25', 'fontweight' : '3'})
+    time_label = ax.annotate("",
             xy=(0.1, .075), xycoords='figure fraction',
             horizontalalignment='left', verticalalignment='bottom',
             fontsize=20)
-    
-    # Save figure
-    filepath = os.path.join(output_path, str(t) + suffix + '.jpg')
-    chart = fig.get_figure()
-    chart.savefig(filepath, dpi=300, bbox_inches='tight')
-    plt.close()
 
-    # Return path to new image
+    return {"fig": fig, "collection": collection, "time_label": time_label, "patch_rows": np.array(patch_rows, dtype=int), "column": column, "suffix": suffix}
+
+# Color a map made by build_map with the values for a frame (one per row of its layer)
+    # Zones with no value (NaN) are left blank
+def draw_map(drawn_map, values, t):
+    drawn_map["collection"].set_array(np.ma.masked_invalid(values[drawn_map["patch_rows"]]))
+    drawn_map["time_label"].set_text(str(t))
+
+# Save a map made by build_map as an image; returns the path to the new image
+def save_map(drawn_map, output_path, t):
+    filepath = os.path.join(output_path, str(t) + drawn_map["suffix"] + '.jpg')
+    drawn_map["fig"].savefig(filepath, dpi=300, bbox_inches='tight')
+
     return filepath
 
+# Render a map made by build_map to an RGB image array in memory, cropped as savefig(bbox_inches='tight') would
+    # The crop is found from the first frame and kept, so every frame of a gif is the same size
+    # savefig places the time label (in figure fraction) within the cropped figure, so it is moved to the same place while drawing
+def map_image(drawn_map):
+    fig = drawn_map["fig"]
+
+    if "crop" not in drawn_map:
+        fig.canvas.draw()
+        bbox = fig.get_tightbbox(fig.canvas.get_renderer()).padded(plt.rcParams["savefig.pad_inches"]).transformed(fig.dpi_scale_trans)
+        height = fig.bbox.height
+        drawn_map["crop"] = (slice(max(0, int(height - bbox.y1)), int(height - bbox.y0)), slice(max(0, int(bbox.x0)), int(bbox.x1)))
+        drawn_map["crop_box"] = bbox
+
+    time_label = drawn_map["time_label"]
+    time_label.xycoords = BboxTransformTo(drawn_map["crop_box"])
+    fig.canvas.draw()
+    time_label.xycoords = "figure fraction"
+    image = np.asarray(fig.canvas.buffer_rgba())
+
+    return image[drawn_map["crop"]][..., :3].copy()
+
+# Set up a worker process for rendering maps: draws with the Agg backend and keeps the polygons for the zones being drawn
+def init_worker(zone_column, map_df, names):
+    matplotlib.use("Agg")
+    worker_layer["zone_column"] = zone_column
+    worker_layer["layer"] = map_df[map_df["nameCol"].isin(names)].reset_index(drop=True)
+    worker_layer["maps"] = {}
+
+# Render a map with the polygons set up by init_worker; takes the mode, data for the frame, color scale, output folder, time, and frame mode
+    # The figure for each mode and color scale is built once, then recolored for every frame that uses it
+    # Saves the map and returns its path, or returns it as an image array if the output folder is None (ie gif frames)
+def render_map(args):
+    mode, subset_data, vmin, vmax, output_path, t, frame_mode = args
+
+    key = (mode, vmin, vmax, frame_mode)
+    if key not in worker_layer["maps"]:
+        worker_layer["maps"][key] = build_map(mode, worker_layer["layer"], vmin, vmax, frame_mode)
+    drawn_map = worker_layer["maps"][key]
+
+    # Match data with polygon dataset
+    values = subset_data.set_index(worker_layer["zone_column"])[drawn_map["column"]].reindex(worker_layer["layer"]["nameCol"]).to_numpy(dtype=float)
+
+    draw_map(drawn_map, values, t)
+    if output_path is None:
+        return map_image(drawn_map)
+
+    return save_map(drawn_map, output_path, t)
+
+# Close the figures built by render_map
+def close_maps():
+    for drawn_map in worker_layer["maps"].values():
+        plt.close(drawn_map["fig"])
+    worker_layer["maps"] = {}
+
+# Render maps for a zone type, across a pool of processes if processes is more than 1
+    # Each map is a tuple of arguments to render_map; yields the results of render_map in the order the maps were given
+    # Workers are forked so they share the loaded map layers; runs in one process where fork is not available (ie Windows)
+def render_maps(maps, zone_column, map_df):
+    if not maps:
+        return
+
+    # Only draw polygons for zones with data
+    names = pd.concat([m[1][zone_column] for m in maps]).unique()
+
+    parallel = processes > 1 and "fork" in multiprocessing.get_all_start_methods()
+    if processes > 1 and not parallel:
+        print("Parallel processing needs the fork start method, which this platform does not have; running in one process")
+
+    if parallel:
+        # Only a few frames per process are queued at once, so finished frames never pile up waiting for the gif writer
+        with ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context("fork"), initializer=init_worker, initargs=(zone_column, map_df, names)) as pool:
+            pending = deque()
+            for m in maps:
+                pending.append(pool.submit(render_map, m))
+                if len(pending) >= 2 * processes:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+    else:
+        init_worker(zone_column, map_df, names)
+        try:
+            for m in maps:
+                yield render_map(m)
+        finally:
+            close_maps()
+
 # UPDATE THIS TO CHANGE FIGURES CREATED (year or quarter)
 mode = "quarter"
 
+# Number of grays in the palette of each gif; the rest of its 256 colors come from the map's color map
+gif_grays = 32
+
+# Number of processes used to render maps in parallel (1 renders them one after another)
+    # Above 1 needs the fork start method, so is only supported on Linux
+processes = 1
+worker_layer = {}
+
 # Define zone types
 zones = {"Community District": "cd", "Police Precinct": "pp", "City Council District": "cc", "Congressional District": "nycongress", "Zipcode": "zipcode" , "State Assembly District": "sa", "State Senate District": "ss", "Neighborhood": None}
 # Define zone types for which the census provides population info
@@ -93,11 +269,10 @@ for z in zones:
 
     # Load in polygons for zone type
     if zones[z]:
-        map_df = gpd.read_file('shapefiles/all_bounds.geojson')
-        map_df = map_df[map_df["id"] == zones[z]]
+        map_df = load_render_layer(zones[z])
         map_df["nameCol"] = map_df["nameCol"].astype(float)
     else:
-        map_df = gpd.read_file('shapefiles/neighborhoods.geojson')
+        map_df = load_render_layer("neighborhoods")
 
     # Find the min and max values for color scale in gif / image
     boundary_value = max(abs(data_change["ARREST_CHANGE"].min()), abs(data_change["ARREST_CHANGE"].max()))
@@ -106,36 +281,33 @@ for z in zones:
     vmin, vmax = -boundary_value, boundary_value
 
     # Create frame for each time unit (quarter or year)
-    frames = []
+    specific_maps, frame_maps = [], []
     for t in time_zones:
         # Filter data based on mode (quarter or year)
         if mode == "year":
             subset_data = data_change[data_change["ARREST_YEAR"] == t]
         else:
             subset_data = data_change.loc[(data_change["ARREST_YEAR"] == int(t.split("-")[0])) & (data_change["ARREST_QUARTER"] == int(t.split("-")[1]))]
-        
-        # Merge data with polygon dataset
-        merged = subset_data.set_index(z.replace(" ", "_")).join(map_df.set_index("nameCol"))
-        merged = gpd.GeoDataFrame(merged)
 
         # Create specific images with specific color scale for latest year or quarter
             # UPDATE t VALUES BASED ON LATEST FULL YEAR OR QUARTER
         if (mode == "year" and t == 2022) or (mode != "year" and t == "2023-1"):
             spec_boundary_value = max(abs(subset_data["ARREST_CHANGE"].min()), abs(subset_data["ARREST_CHANGE"].max()))
-            create_map('increase_specific', merged, -spec_boundary_value, spec_boundary_value, output_path, t, mode)
+            specific_maps.append(('increase_specific', subset_data, -spec_boundary_value, spec_boundary_value, output_path, t, mode))
         
-        # Append gif frame to list
-        frames.append(create_map('increase', merged, vmin, vmax, output_path, t, mode))
+        # Add gif frame to list; frames are kept in memory rather than saved
+        frame_maps.append(('increase', subset_data, vmin, vmax, None, t, mode))
+
+    # Save specific images
+    list(render_maps(specific_maps, z.replace(" ", "_"), map_df))
     
     # Create gif out of frames for each time unit
-    make_gif(frames, output_path + "/" + z.lower().replace(" ", "_") + "_increase_" + mode.upper() + ".gif")
-    # Delete individual images
-    delete_images(frames)
+    make_gif(render_maps(frame_maps, z.replace(" ", "_"), map_df), output_path + "/" + z.lower().replace(" ", "_") + "_increase_" + mode.upper() + ".gif", map_style("increase", mode)[1])
 
     # Create gifs and images for population data if it exists
     if z in pop_zones:
         # Load and filter population data
-        pop_data = pd.read_csv('census_data/census_data_' + z.lower() + '.csv')
+        pop_index = load_population_index(z.replace(" ", "_"))
         data_pop = data[data["ARREST_YEAR"] > 2010] # Census only has data after 2010
         data_pop = data_pop.reset_index()
 
@@ -148,39 +320,15 @@ for z in zones:
             time_zones = list(set(time_zones))
             time_zones.sort()
 
-        # Create arrests by population data for each year or quarter
-        arrests_by_pop = []
-        for index, row in data_pop.iterrows():
-            c = row[z.replace(" ", "_")]
-            year = row["ARREST_YEAR"]
-
-            # Floor all values after 2021 (year of latest census data)
-                # UPDATE YEAR WHEN NEW CENSUS DATA RELEASED
-            if year > 2021:
-                year = 2021.0
-            
-            # Find the population for year and zone
-            subset_pop = pop_data.loc[(pop_data[z.replace(" ", "_")] == c) & (pop_data["Year"] == year)]
-
-            if len(subset_pop.index) > 0:
-                # Say arrests by population is zero if population value is 0 or NaN
-                    # Zeroes out data for zones with missing population values
-                if subset_pop["Population"].iloc[0] == 0 or not subset_pop["Population"].iloc[0]:
-                    arrests_by_pop.append(0)
-                else:
-                    arrests_by_pop.append((row["#_ARRESTS"]/subset_pop["Population"].iloc[0])*100)
-            else:
-                # Zeroes out data for zones not in census data
-                arrests_by_pop.append(0)
-        
-        # Add arrests by population to dataset
-        data_pop["ARRESTS_BY_POP"] = pd.Series(arrests_by_pop)
+        # Add arrests by population to dataset for each year or quarter
+            # Years after the latest census data use its population; zones not in the census or with no population are zeroed out
+        data_pop["ARRESTS_BY_POP"] = arrests_by_pop(pop_index, data_pop, z.replace(" ", "_"))
         
         # Find the max value for color scale in gif / image
         vmin, vmax = 0, data_pop["ARRESTS_BY_POP"].max()
 
         # Create frame for each time unit (quarter or year)
-        frames = []
+        specific_maps, frame_maps = [], []
         for t in time_zones:
             # Filter data based on mode (quarter or year)
             if mode == "year":
@@ -188,19 +336,16 @@ for z in zones:
             else:
                 subset_data = data_pop.loc[(data_pop["ARREST_YEAR"] == int(t.split("-")[0])) & (data_pop["ARREST_QUARTER"] == int(t.split("-")[1]))]
 
-            # Merge data with polygon dataset
-            merged = subset_data.set_index(z.replace(" ", "_")).join(map_df.set_index("nameCol"))
-            merged = gpd.GeoDataFrame(merged)
-
             # Create specific images with specific color scale for latest year or quarter
                 # UPDATE t VALUES BASED ON LATEST FULL YEAR OR QUARTER
             if (mode == "year" and t == 2022) or (mode != "year" and t == "2023-1"):
-                create_map('pop_specific', merged, 0, subset_data["ARRESTS_BY_POP"].max(), output_path, t, mode)
+                specific_maps.append(('pop_specific', subset_data, 0, subset_data["ARRESTS_BY_POP"].max(), output_path, t, mode))
             
-            # Append gif frame to list
-            frames.append(create_map('pop', merged, vmin, vmax, output_path, t, mode))
+            # Add gif frame to list; frames are kept in memory rather than saved
+            frame_maps.append(('pop', subset_data, vmin, vmax, None, t, mode))
+
+        # Save specific images
+        list(render_maps(specific_maps, z.replace(" ", "_"), map_df))
         
         # Create gif out of frames for each time unit
-        make_gif(frames, output_path + "/" + z.lower().replace(" ", "_") + "_by_pop_" + mode.upper() + ".gif")
-        # Delete individual figures
-        delete_images(frames)
\ No newline at end of file
+        make_gif(render_maps(frame_maps, z.replace(" ", "_"), map_df), output_path + "/" + z.lower().replace(" ", "_") + "_by_pop_" + mode.upper() + ".gif", map_style("pop", mode)[1])
\ No newline at end of file
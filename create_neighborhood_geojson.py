@@ -2,6 +2,7 @@ import pandas as pd
 import geopandas as gpd
 from shapely.ops import unary_union
 from data_storage import zip_to_neighborhood, neighborhood_to_zip
+from boundary_cache import load_layer
 
 """
 Create geojson file for neighborhoods
@@ -11,8 +12,7 @@ Create geojson file for neighborhoods
 neighborhoods = list(set(zip_to_neighborhood.values()))
 
 # Read in zipcode objects
-map_df = gpd.read_file('shapefiles/all_bounds.geojson')
-map_df = map_df[map_df["id"] == "zipcode"]
+map_df = load_layer("zipcode")
 
 # Find all zipcodes in map
 zips_in_map = map_df["nameCol"].unique().tolist()
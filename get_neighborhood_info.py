@@ -5,6 +5,8 @@ import numpy as np
 import pandas as pd
 import geopandas as gpd
 import matplotlib.pyplot as plt
+from count_cube import query, cube_labels
+from population_index import load_population_index, arrests_by_pop
 
 """
 Explore arrest data by neighborhood
@@ -21,7 +23,6 @@ census_new_year = 2021
 
 # Read in relevant datasets
 data = pd.read_csv('arrest_data/increase_by_zone/neighborhood_increase_by_' + era + '.csv')
-unfiltered_data = pd.read_csv('arrest_data/arrest_data.csv')
 census_data = pd.read_csv('census_data/census_data_neighborhood.csv')
 
 # Create text file to write data output to
@@ -31,38 +32,27 @@ f = open("neighborhood_info/" + neighborhood.replace(" ", "") + "/neighborhood_i
 if era == "quarter":
     year = new_year
     year_data = data.loc[(data["ARREST_YEAR"] == new_year) & (data["ARREST_QUARTER"] == new_quarter)].reset_index()
-    year_unfiltered_data = unfiltered_data.loc[(unfiltered_data["ARREST_YEAR"] == new_year) & (unfiltered_data["ARREST_QUARTER"] == new_quarter)].reset_index()
+    period = {"ARREST_YEAR": new_year, "ARREST_QUARTER": new_quarter}
 elif era == "year":
     if new_quarter == 3:
         year = new_year
     else:
         year = new_year-1
     year_data = data[data["ARREST_YEAR"] == year].reset_index()
-    year_unfiltered_data = unfiltered_data[unfiltered_data["ARREST_YEAR"] == year].reset_index()
+    period = {"ARREST_YEAR": year}
 
 # Filter census data by year
 year_census_data = census_data[census_data["Year"] == census_new_year].reset_index()
 
 # Get arrests by population
-arrests_by_pop = []
-
-for index, row in year_data.iterrows():
-    neigh = row["Neighborhood"]
-    neigh_population = year_census_data[year_census_data["Neighborhood"] == neigh].iloc[0]["Population"]
-    if neigh_population == 0:
-        by_pop = 0
-    else:
-        by_pop = round((row["#_ARRESTS"]/neigh_population)*100, 2)
-    arrests_by_pop.append(by_pop)
-
-year_data["ARRESTS_BY_POP"] = pd.Series(arrests_by_pop)
+pop_index = load_population_index("Neighborhood")
+year_data["ARRESTS_BY_POP"] = [round(by_pop, 2) for by_pop in arrests_by_pop(pop_index, year_data, "Neighborhood", census_year=census_new_year)]
 
 
 # Filter by neighborhood
 neighborhood_data = year_data[year_data["Neighborhood"] == neighborhood].reset_index() # Filter arrest data to neighborhood for most recent year / quarter
 neighborhood_census_data = year_census_data[year_census_data["Neighborhood"] == neighborhood].reset_index() # Filter census data to neighborhood for most recent year / quarter
-neighborhood_unfiltered_data = year_unfiltered_data[year_unfiltered_data["Neighborhood"] == neighborhood].reset_index() # Filter unfiltered arrest data to neighborhood for most recent year / quarter
-all_neighborhood_unfiltered_data = unfiltered_data[unfiltered_data["Neighborhood"] == neighborhood].reset_index() # Filter unfiltered arrest data to neighborhood
+neighborhood_count = query("Neighborhood", Neighborhood=neighborhood, **period) # Count arrests in neighborhood for most recent year / quarter
 
 
 
@@ -107,19 +97,20 @@ print()
 f.write("\tRank by Arrests by Population: " + str(sort_by_population.index(neighborhood)+1) + "/" + str(len(sort_by_population)) + "\n\n")
 
 # Print / write 5 most common offenses in neighborhood in year / quarter
-prominent_offenses = neighborhood_unfiltered_data["Offense"].value_counts().nlargest(n=5)
+prominent_offenses = query("Neighborhood", ["Offense"], Neighborhood=neighborhood, **period)
+prominent_offenses = prominent_offenses[prominent_offenses > 0].nlargest(n=5)
 print("\tMost Common Offense Types:")
 f.write("\tMost Common Offense Types:\n")
 for o in prominent_offenses.index:
-    print("\t\t" + o + ":", str(round((prominent_offenses[o]/len(neighborhood_unfiltered_data.index))*100, 2)) + "%")
-    f.write("\t\t" + o + ": " + str(round((prominent_offenses[o]/len(neighborhood_unfiltered_data.index))*100, 2)) + "%\n")
+    print("\t\t" + o + ":", str(round((prominent_offenses[o]/neighborhood_count)*100, 2)) + "%")
+    f.write("\t\t" + o + ": " + str(round((prominent_offenses[o]/neighborhood_count)*100, 2)) + "%\n")
 print()
 f.write("\n")
 
 # Find arrests by ages for neighborhood in year / quarter
 ages = ["<18", "18-24", "25-44", "45-64", "65+"]
-age_values_dict = neighborhood_unfiltered_data["AGE_GROUP"].value_counts()
-age_values = [(age_values_dict[a]/len(neighborhood_unfiltered_data.index))*100 for a in ages]
+age_values_dict = query("Neighborhood", ["AGE_GROUP"], Neighborhood=neighborhood, **period)
+age_values = [(age_values_dict[a]/neighborhood_count)*100 for a in ages]
 
 # Plot arrests by ages for neighborhood in year / quarter as bar chart
 plt.figure(figsize = (10, 7.5))
@@ -133,16 +124,15 @@ plt.close()
 
 
 # Plot arrests by age over time
-years = list(set(unfiltered_data["ARREST_YEAR"].tolist()))
-years = sorted(years)
+years = sorted(cube_labels("Neighborhood", "ARREST_YEAR"))
 years = years[:years.index(year)]
 colors = ['green', 'orange', 'blue', 'purple', 'yellow']
 
 plt.figure(figsize = (10, 7.5))
 old_age_values = [0] * len(years)
+age_by_year = query("Neighborhood", ["ARREST_YEAR", "AGE_GROUP"], Neighborhood=neighborhood)
 for a in ages:
-    age_unfiltered = all_neighborhood_unfiltered_data[all_neighborhood_unfiltered_data["AGE_GROUP"] == a]
-    age_values = [len(age_unfiltered[age_unfiltered["ARREST_YEAR"] == y].index) for y in years]
+    age_values = [age_by_year.get((y, a), 0) for y in years]
     plt.bar(years, age_values, color=colors[ages.index(a)], bottom = old_age_values, label = a)
     old_age_values = [old_age_values[i] + age_values[i] for i in range(len(old_age_values))]
 
@@ -160,14 +150,14 @@ plt.close()
 races = ['WHITE', 'BLACK', 'ASIAN / PACIFIC ISLANDER', 'AMERICAN INDIAN / ALASKAN NATIVE', 'TWO+', 'UNKNOWN', 'OTHER']
 
 # Create arrests by race data
-race_values_dict = neighborhood_unfiltered_data["PERP_RACE"].value_counts()
+race_values_dict = query("Neighborhood", ["PERP_RACE"], Neighborhood=neighborhood, **period)
 race_values_arr = []
 for r in races:
     if r in race_values_dict:
         if r in ["WHITE", "BLACK"] and r + " HISPANIC" in race_values_dict:
-            race_values_arr.append(((race_values_dict[r] + race_values_dict[r + " HISPANIC"])/len(neighborhood_unfiltered_data.index))*100)
+            race_values_arr.append(((race_values_dict[r] + race_values_dict[r + " HISPANIC"])/neighborhood_count)*100)
         else:
-            race_values_arr.append((race_values_dict[r]/len(neighborhood_unfiltered_data.index))*100)
+            race_values_arr.append((race_values_dict[r]/neighborhood_count)*100)
     else:
         race_values_arr.append(0)
 
@@ -197,7 +187,7 @@ for r in races + ['WHITE HISPANIC', 'BLACK HISPANIC']:
         ethnicity_values[0] += race_values_dict[r]
 
 for i in range(len(ethnicity_values)):
-    ethnicity_values[i] = (ethnicity_values[i]/len(neighborhood_unfiltered_data.index))*100
+    ethnicity_values[i] = (ethnicity_values[i]/neighborhood_count)*100
 
 # Plot arrests by ethnicity in year / quarter as proportion of bar
 fig, ax = plt.subplots(figsize= (10, 3))
@@ -219,10 +209,10 @@ colors = ['green', 'orange', 'blue', 'purple', 'yellow', 'red', 'pink', 'gray']
 
 plt.figure(figsize = (10, 7.5))
 old_race_values = [0] * len(years)
+race_by_year = query("Neighborhood", ["ARREST_YEAR", "PERP_RACE"], Neighborhood=neighborhood)
 
 for r in races:
-    race_unfiltered = all_neighborhood_unfiltered_data[all_neighborhood_unfiltered_data["PERP_RACE"] == r]
-    race_values = [len(race_unfiltered[race_unfiltered["ARREST_YEAR"] == y].index) for y in years]
+    race_values = [race_by_year.get((y, r), 0) for y in years]
     plt.bar(years, race_values, color=colors[races.index(r)], bottom = old_race_values, label = r)
     old_race_values = [old_race_values[i] + race_values[i] for i in range(len(old_race_values))]
 
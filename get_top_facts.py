@@ -1,6 +1,7 @@
 import scipy.stats
 import pandas as pd
 import matplotlib.pyplot as plt
+from count_cube import query
 
 """
 Rough data production file: Creates figures describing general arrest trends
@@ -12,7 +13,6 @@ new_quarter = 1
 new_census_year = 2021
 
 # Read in datasets
-data = pd.read_csv('arrest_data/arrest_data.csv', low_memory=False)
 census_data = pd.read_csv('census_data/census_data_neighborhood.csv', low_memory=False)
 
 # Calculate newest year for which complete data is available
@@ -22,7 +22,7 @@ if new_quarter < 3:
     new_full_year = new_year-1
 
 # Create specific datasets
-data_by_year = data.groupby(["ARREST_YEAR"])["ARREST_KEY"].size().reset_index(name = "COUNT") # Number of arrests by year
+data_by_year = query("All", ["ARREST_YEAR"]).reset_index(name = "COUNT") # Number of arrests by year
 data_newest = data_by_year[data_by_year["ARREST_YEAR"] == new_full_year] # Arrest data for newest full year
 data_comp = data_by_year[data_by_year["ARREST_YEAR"] == new_full_year-1] # Arrest data for second-newest full year
 year_change = ((data_newest.iloc[0]["COUNT"] - data_comp.iloc[0]["COUNT"])/data_comp.iloc[0]["COUNT"])*100 # Get change in arrests between two most recent full years
@@ -41,8 +41,7 @@ white_population = sum([p for p in white_population if not pd.isna(p)])
 print("% of NYC Population Estimated Non-White in 2021: " + str(round(((total_population-white_population)/total_population)*100, 2)))
 
 # Calculate the % of arrests that were of non-white individuals in the newest full year of data
-data_newest = data[data["ARREST_YEAR"] == new_full_year]
-data_newest_by_race = data.groupby(["PERP_RACE"])["ARREST_KEY"].size().reset_index(name = "COUNT")
+data_newest_by_race = query("All", ["PERP_RACE"]).reset_index(name = "COUNT")
 white_count = data_newest_by_race[data_newest_by_race["PERP_RACE"] == "WHITE"].iloc[0]["COUNT"] + data_newest_by_race[data_newest_by_race["PERP_RACE"] == "WHITE HISPANIC"].iloc[0]["COUNT"]
 total_count = sum(data_newest_by_race["COUNT"].tolist())
 print("% of NYC Arrests Non-White in " + str(new_full_year) + ": " + str(round(((total_count-white_count)/total_count)*100, 2)))
@@ -0,0 +1,67 @@
+from collections import deque
+from data_storage import legal_code_to_offense
+
+"""
+Classifies arrests into offense types from their law codes
+"""
+
+
+# Build a trie over the legal codes, with Aho-Corasick failure links so every code appearing anywhere in a law code is found in one scan
+    # Each node is a dict of children; fail holds each node's failure link and out the positions (in codes) of the codes ending there
+def build_code_matcher(codes):
+    children, fail, out = [{}], [0], [[]]
+
+    for rank, code in enumerate(codes):
+        node = 0
+        for ch in code:
+            if ch not in children[node]:
+                children.append({})
+                fail.append(0)
+                out.append([])
+                children[node][ch] = len(children) - 1
+            node = children[node][ch]
+        out[node].append(rank)
+
+    # Link each node to the node for its longest proper suffix in the trie, breadth first
+    queue = deque(children[0].values())
+    while queue:
+        node = queue.popleft()
+        for ch, child in children[node].items():
+            f = fail[node]
+            while f and ch not in children[f]:
+                f = fail[f]
+            fail[child] = children[f].get(ch, 0)
+            out[child] = out[child] + out[fail[child]]
+            queue.append(child)
+
+    return children, fail, out
+
+
+# Find the offense for a law code, given the matcher built from a list of legal codes and the offense for each of those codes
+    # Precedence: if several legal codes appear in the law code, the one listed last wins
+    # If none appear, the offense is "Other"
+def classify_offense(matcher, offenses, law_code):
+    children, fail, out = matcher
+    node = 0
+    last = -1
+
+    for ch in law_code:
+        while node and ch not in children[node]:
+            node = fail[node]
+        node = children[node].get(ch, 0)
+        if out[node]:
+            last = max(last, max(out[node]))
+
+    if last == -1:
+        return "Other"
+    return offenses[last]
+
+
+# Get the offense descriptions (from law code) for each entry in the dataset
+    # Each distinct law code is classified once, then mapped back on to every entry
+def get_offenses(data):
+    matcher = build_code_matcher(list(legal_code_to_offense))
+    offenses = list(legal_code_to_offense.values())
+    found = {lc: classify_offense(matcher, offenses, str(lc)) for lc in data["LAW_CODE"].dropna().unique()}
+
+    return data["LAW_CODE"].map(found).fillna("Other")
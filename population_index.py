@@ -0,0 +1,53 @@
+import os
+import numpy as np
+import pandas as pd
+
+"""
+Looks up census populations by zone and year, so arrests can be compared to population for every row of a dataset at once
+"""
+
+census_folder = "census_data"
+
+
+# Load the population of each zone in each census year for a zone type with census data ("Zipcode" or "Neighborhood")
+    # Returns the zones, the census years (sorted), and a zone x year array of populations (NaN where the census has no value)
+def load_population_index(zone_type):
+    census = pd.read_csv(os.path.join(census_folder, "census_data_" + zone_type.lower() + ".csv"), usecols=[zone_type, "Year", "Population"])
+    census = census.drop_duplicates(subset=[zone_type, "Year"], keep="first")
+
+    zone_i, zones = pd.factorize(census[zone_type])
+    year_i, years = pd.factorize(census["Year"], sort=True)
+
+    populations = np.full((len(zones), len(years)), np.nan)
+    populations[zone_i, year_i] = census["Population"].to_numpy(dtype=float)
+
+    return {"zones": pd.Index(zones), "years": pd.Index(years), "populations": populations}
+
+
+# Find the population of each zone in the given year (one zone and year per row)
+    # Years after the latest census year use the latest census year; other years must be census years
+    # Zones or years not in the census have no population (NaN)
+def zone_populations(index, zones, years):
+    years = np.minimum(np.asarray(years), index["years"][-1])
+    zone_i = index["zones"].get_indexer(zones)
+    year_i = index["years"].get_indexer(years)
+
+    populations = np.full(len(zone_i), np.nan)
+    found = (zone_i >= 0) & (year_i >= 0)
+    populations[found] = index["populations"][zone_i[found], year_i[found]]
+
+    return populations
+
+
+# Find arrests per 100 people for each row of arrest data (a zone column, ARREST_YEAR, and #_ARRESTS)
+    # Uses the population in census_year if given, otherwise the population in each row's arrest year
+    # Zones with no population (missing from the census, missing values, or zero) get zero
+def arrests_by_pop(index, data, zone_column, census_year=None):
+    years = data["ARREST_YEAR"].to_numpy() if census_year is None else np.full(len(data.index), census_year)
+    populations = zone_populations(index, data[zone_column].to_numpy(), years)
+
+    by_pop = np.zeros(len(data.index))
+    has_population = populations > 0
+    by_pop[has_population] = (data["#_ARRESTS"].to_numpy()[has_population]/populations[has_population])*100
+
+    return by_pop
@@ -0,0 +1,32 @@
+import numpy as np
+import pandas as pd
+from offense_codes import build_code_matcher, classify_offense, get_offenses
+
+
+# When several legal codes appear in a law code, the one listed last in legal_code_to_offense wins ("PL 120" is listed before "VTL")
+def test_last_listed_code_wins():
+    data = pd.DataFrame({"LAW_CODE": ["PL 1200500", "VTL 0511001", "PL 1200500 VTL"]})
+
+    assert get_offenses(data).tolist() == ["Offenses Against the Person", "Vehicle and Traffic Law", "Vehicle and Traffic Law"]
+
+
+# A code that appears inside a longer code is still found, and list order decides between them
+def test_code_inside_another():
+    codes = ["PL 1", "PL 12"]
+
+    assert classify_offense(build_code_matcher(codes), ["Short", "Long"], "PL 1234") == "Long"
+    assert classify_offense(build_code_matcher(codes[::-1]), ["Long", "Short"], "PL 1234") == "Short"
+    assert classify_offense(build_code_matcher(["XPL 1", "PL 1"]), ["Outer", "Inner"], "XPL 1") == "Inner"
+
+
+# Law codes containing no legal code are "Other"
+def test_no_match():
+    assert classify_offense(build_code_matcher(["PL 1", "VTL"]), ["A", "B"], "XYZ 123") == "Other"
+    assert get_offenses(pd.DataFrame({"LAW_CODE": ["XYZ 123"]})).tolist() == ["Other"]
+
+
+# Missing law codes are "Other"
+def test_missing_law_code():
+    data = pd.DataFrame({"LAW_CODE": [np.nan, "VTL 0511001", None]})
+
+    assert get_offenses(data).tolist() == ["Other", "Vehicle and Traffic Law", "Other"]
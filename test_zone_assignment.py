@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+import pytest
+import shapely
+from zone_assignment import build_zone_layers, assign_zones, assign_zones_cached, load_zone_cache, save_zone_cache
+
+# Two side by side zones and one overlapping both, plus a zipcode layer with a hard coded answer
+shapes = pd.DataFrame({"id": ["cd", "cd", "cd", "zipcode", "zipcode"],
+                       "nameCol": ["101", "102", "103", "10001", "10002"],
+                       "geometry": [shapely.box(0, 0, 1, 1), shapely.box(1, 0, 2, 1), shapely.box(0.6, 0.6, 1.6, 1.6),
+                                    shapely.box(0, 0, 2, 2), shapely.Polygon([(2, 0), (4, 0), (4, 2), (2.5, 1)])]})
+modes = ["cd", "zipcode"]
+
+# Points inside one zone, inside several, outside every zone, with no location (0), and with a hard coded answer; some points repeat
+x = np.array([0.2, 1.5, 0.9, 1.05, 1.3, 3.0, -0.5, 0, 0.2, -73.950348, 1.5, 2.6])
+y = np.array([0.2, 0.3, 0.9, 0.95, 1.3, 3.0, 0.5, 0, 0.2, 40.706283, 0.3, 0.5])
+
+
+# Find the zone for a point one polygon at a time, as add_correct_zones.py did before zones were assigned in bulk
+def get_zone(shapes_df, mode, point):
+    if point.x == 0:
+        return None
+    elif mode == "zipcode" and point.y == 40.706283 and point.x == -73.950348:
+        return "11211"
+
+    poss_zones = shapes_df[[g.contains(point) for g in shapes_df["geometry"]]]
+    if len(poss_zones.index) == 1:
+        return poss_zones.iloc[0]["nameCol"]
+    elif len(poss_zones.index) == 0:
+        min_dist, z = 1000, None
+        for i, r in shapes_df.iterrows():
+            if point.distance(r["geometry"]) < min_dist:
+                min_dist, z = point.distance(r["geometry"]), r["nameCol"]
+        return z
+    else:
+        max_dist, z = 0, None
+        for i, r in poss_zones.iterrows():
+            if r["geometry"].exterior.distance(point) > max_dist:
+                max_dist, z = r["geometry"].exterior.distance(point), r["nameCol"]
+        return z
+
+
+def expected_zones():
+    return {mode: [get_zone(shapes[shapes["id"] == mode], mode, shapely.Point(px, py)) for px, py in zip(x, y)] for mode in modes}
+
+
+# Cached assignment gives the same zones as finding each point one at a time, both with an empty cache and with every point cached
+@pytest.mark.parametrize("simplify_tolerance", [None, 0.01])
+def test_cached_matches_get_zone(tmp_path, simplify_tolerance):
+    layers = build_zone_layers(shapes, modes, simplify_tolerance)
+    expected = expected_zones()
+    cache_file = str(tmp_path / "zone_cache.pkl")
+    n_coords = len(set(zip(x, y)))
+
+    cache = load_zone_cache(cache_file, "hash", modes)
+    zone_values, zone_counts, cached = assign_zones_cached(layers, None, cache, x, y)
+    assert cached == 0
+    assert {mode: list(zone_values[mode]) for mode in modes} == expected
+
+    save_zone_cache(cache_file, cache)
+    cache = load_zone_cache(cache_file, "hash", modes)
+    zone_values, zone_counts, cached = assign_zones_cached(layers, None, cache, x, y)
+    assert cached == n_coords
+    assert {mode: list(zone_values[mode]) for mode in modes} == expected
+
+    # Uncached assignment gives the same zones too
+    zone_values, zone_counts = assign_zones(layers, x, y)
+    assert {mode: list(zone_values[mode]) for mode in modes} == expected
+
+
+# The cache is discarded when it was built from a different boundary file or different zone types
+def test_cache_discarded_when_inputs_change(tmp_path):
+    layers = build_zone_layers(shapes, modes)
+    cache_file = str(tmp_path / "zone_cache.pkl")
+
+    cache = load_zone_cache(cache_file, "hash", modes)
+    assign_zones_cached(layers, None, cache, x, y)
+    save_zone_cache(cache_file, cache)
+
+    assert len(load_zone_cache(cache_file, "hash", modes)["zones"].index) > 0
+    assert len(load_zone_cache(cache_file, "other hash", modes)["zones"].index) == 0
+    assert len(load_zone_cache(cache_file, "hash", ["cd"])["zones"].index) == 0
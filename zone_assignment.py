@@ -0,0 +1,369 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+import shapely
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from shapely.strtree import STRtree
+from boundary_cache import load_bounds, update_cache
+
+"""
+Assigns arrest locations to zones in bulk, using a spatial index over the zone polygons
+"""
+
+# Hard coded answers to common errors, keyed by zone type and (longitude, latitude)
+zone_overrides = {"zipcode": {(-73.950348, 40.706283): "11211"}}
+
+# Points outside every zone are only given a zone nearer than this
+max_zone_distance = 1000
+
+# Size (in degrees) of the cells of the zone grid
+grid_cell_size = 0.001
+# Cells are tested slightly enlarged, so points on a cell edge that round into the cell are still covered
+grid_margin = 1e-9
+
+# Points closer than this many simplification tolerances to a simplified zone boundary are tested against the full shape
+simplify_band = 2
+
+# Zone layers loaded in each worker process
+worker_layers = {}
+
+
+# Find the outer ring of each polygon; for multipolygons, the outer rings of every part
+def exterior_rings(geoms):
+    rings = shapely.get_exterior_ring(geoms)
+
+    for i in np.flatnonzero(shapely.get_type_id(geoms) == shapely.GeometryType.MULTIPOLYGON):
+        rings[i] = shapely.multilinestrings(shapely.get_exterior_ring(shapely.get_parts(geoms[i])))
+
+    return rings
+
+
+# Build a spatial index over the polygons of each zone type, preparing the polygons for fast containment tests
+    # If simplify_tolerance (in degrees) is given, also build shapes for a fast path from a topology-preserving simplification of each polygon:
+    # "inner" holds points at least simplify_band tolerances inside the simplified edge, which are inside the full shape,
+    # and "outer" misses points at least simplify_band tolerances outside it, which are outside the full shape
+    # Invalid polygons can simplify and buffer unpredictably, so they get no fast path: an empty "inner" and the full shape as "outer"
+def build_zone_layers(shapes, modes, simplify_tolerance=None):
+    layers = {}
+
+    for mode in modes:
+        shapes_df = shapes[shapes["id"] == mode]
+        geoms = shapes_df["geometry"].to_numpy()
+        shapely.prepare(geoms)
+
+        layers[mode] = {"names": shapes_df["nameCol"].to_numpy(), "geoms": geoms, "exteriors": exterior_rings(geoms), "tree": STRtree(geoms), "simplify_tolerance": simplify_tolerance}
+
+        if simplify_tolerance:
+            simplified = shapely.simplify(geoms, simplify_tolerance, preserve_topology=True)
+            layers[mode]["inner"] = shapely.buffer(simplified, -simplify_band * simplify_tolerance)
+            layers[mode]["outer"] = shapely.buffer(simplified, simplify_band * simplify_tolerance)
+
+            invalid = ~shapely.is_valid(geoms)
+            layers[mode]["inner"][invalid] = shapely.Polygon()
+            layers[mode]["outer"][invalid] = geoms[invalid]
+            shapely.prepare(layers[mode]["inner"])
+            shapely.prepare(layers[mode]["outer"])
+
+    return layers
+
+
+# Find which (point, polygon) pairs have the point inside the polygon
+    # Uses the simplified shapes where the layer has them, so only points near a boundary are tested against the full shape
+    # Also returns the number of points tested against a full shape
+def contains_points(layer, points, point_idx, poly_idx):
+    if "inner" not in layer:
+        return shapely.contains(layer["geoms"][poly_idx], points[point_idx]), len(np.unique(point_idx))
+
+    inside = shapely.contains(layer["inner"][poly_idx], points[point_idx])
+    exact = ~inside & shapely.contains(layer["outer"][poly_idx], points[point_idx])
+    inside[exact] = shapely.contains(layer["geoms"][poly_idx[exact]], points[point_idx[exact]])
+
+    return inside, len(np.unique(point_idx[exact]))
+
+
+# Find the zone nearest to each point that is not in any zone
+def nearest_zones(layer, points):
+    zone_idx = np.full(len(points), -1, dtype=np.int32)
+
+    # Find the nearest polygons for all points at once; equally near polygons are all returned
+    (point_idx, poly_idx), dists = layer["tree"].query_nearest(points, max_distance=max_zone_distance, return_distance=True)
+    keep = dists < max_zone_distance
+    point_idx, poly_idx = point_idx[keep], poly_idx[keep]
+
+    # Break ties in favour of the first polygon in the file
+    order = np.lexsort((poly_idx, point_idx))
+    point_idx, poly_idx = point_idx[order], poly_idx[order]
+    first = np.ones(len(point_idx), dtype=bool)
+    first[1:] = point_idx[1:] != point_idx[:-1]
+    zone_idx[point_idx[first]] = poly_idx[first]
+
+    return zone_idx
+
+
+# Find the zone each point is farthest in to, for points in multiple zones
+    # point_idx and poly_idx list every (point, polygon) containment pair, sorted by point
+def deepest_zones(layer, points, point_idx, poly_idx):
+    dists = shapely.distance(layer["exteriors"][poly_idx], points[point_idx])
+
+    # Take the polygon with the greatest distance to its edge, breaking ties in favour of the first polygon in the file
+    order = np.lexsort((poly_idx, -dists, point_idx))
+    point_idx, poly_idx, dists = point_idx[order], poly_idx[order], dists[order]
+    first = np.ones(len(point_idx), dtype=bool)
+    first[1:] = point_idx[1:] != point_idx[:-1]
+
+    # Points lying on the edge of every candidate polygon have no zone
+    return point_idx[first], np.where(dists[first] > 0, poly_idx[first], -1)
+
+
+# Find the zone position stored in the zone grid for each point; -1 where the point's cell touches a zone boundary or is outside the grid
+def grid_zones(grid, x, y):
+    cells = grid["cells"]
+    col = np.floor((x - grid["x0"]) / grid["cell_size"]).astype(np.int64)
+    row = np.floor((y - grid["y0"]) / grid["cell_size"]).astype(np.int64)
+    inside = (col >= 0) & (col < cells.shape[1]) & (row >= 0) & (row < cells.shape[0])
+
+    zone_idx = np.full(len(x), -1, dtype=np.int32)
+    zone_idx[inside] = cells[row[inside], col[inside]]
+
+    return zone_idx
+
+
+# Find the position (within the layer) of the zone for each point; -1 where no zone is found
+    # Also returns counts of the points found in the zone grid, the points tested against a full shape, and the points that needed the nearest-zone or farthest-in fallback
+def locate_zones(layer, x, y):
+    # Use the zone grid if there is one, and only test the remaining points against the polygons
+    if "grid" in layer:
+        zone_idx = grid_zones(layer["grid"], x, y)
+    else:
+        zone_idx = np.full(len(x), -1, dtype=np.int32)
+    from_grid = np.count_nonzero(zone_idx != -1)
+
+    located = np.flatnonzero((x != 0) & (zone_idx == -1))
+    points = shapely.points(x[located], y[located])
+
+    # Find every (point, polygon) pair where the point is inside the polygon, checking only polygons whose bounding box holds the point
+    point_idx, poly_idx = layer["tree"].query(points)
+    inside, exact = contains_points(layer, points, point_idx, poly_idx)
+    point_idx, poly_idx = point_idx[inside], poly_idx[inside]
+    order = np.lexsort((poly_idx, point_idx))
+    point_idx, poly_idx = point_idx[order], poly_idx[order]
+    matches = np.bincount(point_idx, minlength=len(points))
+
+    # Points in exactly one zone
+    single = matches[point_idx] == 1
+    zone_idx[located[point_idx[single]]] = poly_idx[single]
+
+    # If the point is not in any zone, find the zone it is nearest to
+    unmatched = np.flatnonzero(matches == 0)
+    zone_idx[located[unmatched]] = nearest_zones(layer, points[unmatched])
+
+    # If the point is in multiple zones, choose the zone it is farthest in to
+    multi = matches[point_idx] > 1
+    ambiguous, deepest = deepest_zones(layer, points, point_idx[multi], poly_idx[multi])
+    zone_idx[located[ambiguous]] = deepest
+
+    return zone_idx, {"grid": from_grid, "exact": exact, "unmatched": len(unmatched), "ambiguous": len(ambiguous)}
+
+
+# Convert zone positions to zone names, applying any hard coded answers
+def zone_names(layer, mode, zone_idx, x, y):
+    names = np.append(layer["names"].astype(object), None)[zone_idx]
+
+    for (lon, lat), name in zone_overrides.get(mode, {}).items():
+        names[(x == lon) & (y == lat)] = name
+
+    return names
+
+
+# Find the zone (specified by mode) for each point, along with the fallback counts from locate_zones
+def assign_zone(layer, mode, x, y):
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    zone_idx, counts = locate_zones(layer, x, y)
+
+    return zone_names(layer, mode, zone_idx, x, y), counts
+
+
+# Find the zones of every zone type for each point
+def assign_zones(layers, x, y):
+    zone_values = {}
+    zone_counts = {}
+
+    for mode in layers:
+        zone_values[mode], zone_counts[mode] = assign_zone(layers[mode], mode, x, y)
+
+    return zone_values, zone_counts
+
+
+# Load the zone layers (and zone grid, if used) once in each worker process
+    # The zone grid is only opened, never built, here; the parent process builds it with attach_zone_grid before starting workers
+def init_worker(bounds_file, modes, grid_file, simplify_tolerance):
+    global worker_layers
+    worker_layers = build_zone_layers(load_bounds(modes, bounds_file), modes, simplify_tolerance)
+
+    if grid_file:
+        open_zone_grid(worker_layers, grid_file)
+
+
+# Find the zone positions of every zone type for one shard of points
+def locate_shard(x, y):
+    return {mode: locate_zones(worker_layers[mode], x, y) for mode in worker_layers}
+
+
+# Find the zones of every zone type for each point, splitting the points into shards across a pool of worker processes
+    # Gives the same result as assign_zones
+def assign_zones_parallel(layers, bounds_file, x, y, processes, grid_file=None):
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    shards = np.array_split(np.arange(len(x)), processes * 4)
+    simplify_tolerance = next(iter(layers.values()))["simplify_tolerance"]
+
+    # Workers are forked so that running scripts are not re-imported in each worker
+    with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("fork"), initializer=init_worker, initargs=(bounds_file, list(layers), grid_file, simplify_tolerance)) as pool:
+        results = list(pool.map(locate_shard, [x[s] for s in shards], [y[s] for s in shards]))
+
+    # Merge shards back together in order
+    zone_values = {}
+    zone_counts = {}
+
+    for mode in layers:
+        zone_idx = np.concatenate([r[mode][0] for r in results])
+        zone_values[mode] = zone_names(layers[mode], mode, zone_idx, x, y)
+        zone_counts[mode] = {c: sum(r[mode][1][c] for r in results) for c in results[0][mode][1]}
+
+    return zone_values, zone_counts
+
+
+# Build a grid of cells over all zones
+    # For each zone type, a cell holds the position of the zone it lies entirely inside of, or -1 if it touches a zone boundary
+def build_zone_grid(layers, cell_size):
+    x0, y0 = np.min([shapely.total_bounds(layers[mode]["geoms"])[:2] for mode in layers], axis=0)
+    x1, y1 = np.max([shapely.total_bounds(layers[mode]["geoms"])[2:] for mode in layers], axis=0)
+    nx = int(np.ceil((x1 - x0) / cell_size))
+    ny = int(np.ceil((y1 - y0) / cell_size))
+
+    # Create a box for each cell, row by row
+    cell_x, cell_y = np.meshgrid(x0 + np.arange(nx) * cell_size, y0 + np.arange(ny) * cell_size)
+    cell_x, cell_y = cell_x.ravel(), cell_y.ravel()
+    boxes = shapely.box(cell_x - grid_margin, cell_y - grid_margin, cell_x + cell_size + grid_margin, cell_y + cell_size + grid_margin)
+
+    cells = np.full((len(layers), ny * nx), -1, dtype=np.int16)
+    for k, mode in enumerate(layers):
+        geoms = layers[mode]["geoms"]
+        shapely.prepare(geoms)
+
+        # Keep cells touching exactly one polygon that lie strictly inside that polygon
+        cell_idx, poly_idx = layers[mode]["tree"].query(boxes, predicate="intersects")
+        touching = np.bincount(cell_idx, minlength=len(boxes))
+        one = touching[cell_idx] == 1
+        cell_idx, poly_idx = cell_idx[one], poly_idx[one]
+        inside = shapely.contains_properly(geoms[poly_idx], boxes[cell_idx])
+        cells[k, cell_idx[inside]] = poly_idx[inside]
+
+    return cells.reshape(len(layers), ny, nx), float(x0), float(y0)
+
+
+# Add the zone grid to each zone layer, building and saving the grid first if it is missing or out of date
+    # The grid is stored as a .npy file and memory-mapped, with its details in a .json file alongside it
+def attach_zone_grid(layers, bounds_file, grid_file, cell_size=grid_cell_size):
+    info_file = os.path.splitext(grid_file)[0] + ".json"
+    info = {"source_hash": update_cache(bounds_file), "modes": list(layers), "cell_size": cell_size}
+
+    # Check whether the saved grid was built from the same boundary file and zone types
+    saved_info = None
+    if os.path.exists(grid_file) and os.path.exists(info_file):
+        with open(info_file) as f:
+            saved_info = json.load(f)
+
+    if saved_info is None or any(saved_info[k] != info[k] for k in info):
+        cells, info["x0"], info["y0"] = build_zone_grid(layers, cell_size)
+
+        grid = np.lib.format.open_memmap(grid_file, mode="w+", dtype=cells.dtype, shape=cells.shape)
+        grid[:] = cells
+        grid.flush()
+        del grid
+
+        with open(info_file, "w") as f:
+            json.dump(info, f)
+
+    open_zone_grid(layers, grid_file)
+
+
+# Add a zone grid already saved by attach_zone_grid to each zone layer, memory-mapping the grid as it was built (whatever its cell size)
+def open_zone_grid(layers, grid_file):
+    with open(os.path.splitext(grid_file)[0] + ".json") as f:
+        info = json.load(f)
+
+    cells = np.load(grid_file, mmap_mode="r")
+    for k, mode in enumerate(layers):
+        layers[mode]["grid"] = {"cells": cells[k], "x0": info["x0"], "y0": info["y0"], "cell_size": info["cell_size"]}
+
+
+# Find the details the zone cache depends on: the boundary file, the zone types, and the hard coded answers
+def zone_cache_info(source_hash, modes):
+    return {"source_hash": source_hash, "modes": list(modes), "zone_overrides": zone_overrides}
+
+
+# Load zones already found for each (longitude, latitude) pair, held in memory until save_zone_cache is called
+    # The cache is ignored if it was built from a different boundary file, different zone types, or different hard coded answers
+def load_zone_cache(cache_file, source_hash, modes):
+    info = zone_cache_info(source_hash, modes)
+
+    if os.path.exists(cache_file):
+        cache = pd.read_pickle(cache_file)
+        if all(cache.get(k) == info[k] for k in info):
+            return {**cache, "changed": False}
+
+    zones = pd.DataFrame(columns=list(modes), index=pd.MultiIndex.from_arrays([[], []], names=["Longitude", "Latitude"]), dtype=object)
+    return {**info, "zones": zones, "changed": False}
+
+
+# Save the zone cache, if any zones were added since it was loaded
+def save_zone_cache(cache_file, cache):
+    if cache["changed"]:
+        pd.to_pickle({k: cache[k] for k in cache if k != "changed"}, cache_file)
+        cache["changed"] = False
+
+
+# Find the size (in bytes) of the zone cache in memory
+def zone_cache_size(cache):
+    return int(cache["zones"].memory_usage(deep=True).sum())
+
+
+# Find the zones of every zone type for each point, only running geometry for coordinates not already in the cache
+    # Zones found for new coordinates are added to the cache (loaded by load_zone_cache), which is only written out by save_zone_cache
+    # Also returns the number of distinct coordinates found in the cache
+    # Workers for processes above 1 are forked; where fork is not available (ie Windows) every point is found in one process
+def assign_zones_cached(layers, bounds_file, cache, x, y, processes=1, grid_file=None):
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+
+    # Find each distinct coordinate pair, and those never seen before
+    # factorize drops the level names, so they are set again
+    codes, coords = pd.MultiIndex.from_arrays([x, y]).factorize()
+    coords = coords.set_names(["Longitude", "Latitude"])
+    new_coords = coords[~coords.isin(cache["zones"].index)]
+    new_x = new_coords.get_level_values("Longitude").to_numpy(dtype=float)
+    new_y = new_coords.get_level_values("Latitude").to_numpy(dtype=float)
+
+    parallel = processes > 1 and "fork" in multiprocessing.get_all_start_methods()
+    if processes > 1 and not parallel:
+        print("Parallel processing needs the fork start method, which this platform does not have; running in one process")
+
+    # Find zones for new coordinates and add them to the cache
+    if parallel and len(new_coords) > 0:
+        new_values, zone_counts = assign_zones_parallel(layers, bounds_file, new_x, new_y, processes, grid_file)
+    else:
+        new_values, zone_counts = assign_zones(layers, new_x, new_y)
+
+    if len(new_coords) > 0:
+        cache["zones"] = pd.concat([cache["zones"], pd.DataFrame(new_values, index=new_coords, dtype=object)])
+        cache["changed"] = True
+
+    # Look up zones for every point from its coordinate pair
+    found = cache["zones"].reindex(coords)
+    zone_values = {mode: found[mode].to_numpy()[codes] for mode in layers}
+
+    return zone_values, zone_counts, len(coords) - len(new_coords)